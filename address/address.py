@@ -1,17 +1,53 @@
 # Meant to parse out address lines, minus city,state,zip into a usable dict for address matching
 # Ignores periods and commas, because no one cares.
 
+from __future__ import print_function
 import re
 import csv
 import os
-import dstk
 import sys
+import time
+try:
+    from . import dstk
+    from .geocoder import LocalGeocoder
+    from .lexicon import Lexicon
+    from .transport import PooledTransport
+except (ImportError, ValueError):
+    # Run as a script
+    import dstk
+    from geocoder import LocalGeocoder
+    from lexicon import Lexicon
+    from transport import PooledTransport
+
+if sys.version_info[0] >= 3:
+    text_type = str
+else:
+    text_type = unicode
 
 # Keep lowercase, no periods
 # Requires numbers first, then option dash plus numbers.
 street_num_regex = r'^(\d+)(-?)(\d*)$'
 
 apartment_regex_number = r'(#?)(\d*)(\w*)'
+# Patterns run over the whole input are compiled once and can only start at a token boundary. That keeps "rm" from
+# matching inside "Storm", and means a failed match is never retried from every character of a long word, so each
+# pattern runs in linear time over the input.
+units_regex = re.compile(r"-?-?(?<!\w)\w+ units", re.IGNORECASE)
+apartment_regexes = [re.compile(regex, re.IGNORECASE) for regex in
+                     (r'#\w+ & \w+', r'#\w+ rm \w+', r"#\w+-\w", r'(?<!\w)apt #{0,1}\w+', r'(?<!\w)apartment #{0,1}\w+',
+                      r'#\w+', r'# \w+', r'(?<!\w)rm \w+', r'(?<!\w)unit #?\w+', r'(?<!\w)units #?\w+', r'- #{0,1}\w+',
+                      r'(?<!\w)no\s?\d+\w*', r'(?<!\w)style\s\w{1,2}', r'(?<!\w)townhouse style\s\w{1,2}')]
+# Matched against a single token, so already bounded by the token
+apartment_token_regexes = [re.compile(regex) for regex in
+                           (r'#\w+ & \w+', r'#\w+ rm \w+', r"#\w+-\w", r'apt #{0,1}\w+', r'apartment #{0,1}\w+', r'#\w+',
+                            r'# \w+', r'rm \w+', r'unit #?\w+', r'units #?\w+', r'- #{0,1}\w+', r'no\s?\d+\w*',
+                            r'style\s\w{1,2}', r'\d{1,4}/\d{1,4}', r'\d{1,4}', r'\w{1,2}')]
+# Used by AddressParser.looks_like_address
+digit_token_regex = re.compile(r'(?:^|[\s,#])\d')
+word_regex = re.compile(r'[a-z]+')
+state_code_regex = re.compile(r'\b[A-Z]{2}\b')
+# A whitespace separated token, without the periods and commas at either end, for Address.token_spans
+span_token_regex = re.compile(r'[^\s.,](?:\S*[^\s.,])?')
 cwd = os.path.dirname(os.path.realpath(__file__))
 
 
@@ -20,12 +56,18 @@ class AddressParser(object):
     AddressParser will be use to create Address objects. It contains a list of preseeded cities, states, prefixes,
     suffixes, and street names that will help the Address object correctly parse the given string. It is loaded
     with defaults that work in the average case, but can be adjusted for specific cases.
+
+    Parse state lives on each Address, so one parser can be shared by many threads. An unfrozen parser's lexicon
+    still fills some lookup tables and per state city lists on first use, each with a single reference assignment.
+    Call freeze() once the parser is set up: those are filled up front, parsing no longer writes to the parser or
+    its lexicon, and the load_* methods raise ValueError. Network I/O for the dstk and hybrid backends happens in
+    socket calls that release the GIL, and all threads share the DSTK client's connection pool, whose own state
+    is guarded by locks.
+
+    The suffixes, cities and streets live in a Lexicon. swap_lexicon() and reload_lexicon() replace it on a live
+    parser, frozen or not; parses already running finish on the lexicon they started with.
     """
-    suffixes = {}
-    # Lower case list of cities, used as a hint
-    cities = []
-    # Lower case list of streets, used as a hint
-    streets = []
+    frozen = False
     prefixes = {
         "n": "N.", "e": "E.", "s": "S.", "w": "W.", "ne": "NE.", "nw": "NW.", 'se': "SE.", 'sw': "SW.", 'north': "N.",
         'east': "E.", 'south': "S.",
@@ -42,7 +84,10 @@ class AddressParser(object):
         'Washington': 'WA', 'North Carolina': 'NC', 'District of Columbia': 'DC', 'Texas': 'TX', 'Nevada': 'NV',
         'Maine': 'ME', 'Rhode Island': 'RI'}
 
-    def __init__(self, suffixes=None, cities=None, streets=None, backend="default", dstk_api_base=None, logger=None, required_confidence=0.65):
+    def __init__(self, suffixes=None, cities=None, streets=None, backend="default", dstk_api_base=None, logger=None,
+                 required_confidence=0.65, zip_states=None, zip_cities=None, geocoder_file=None,
+                 required_local_confidence=0.7, dstk_options=None, dstk_fallback=False, text_native=None,
+                 record_spans=False, max_length=1000, max_tokens=100, time_budget=None, cities_dir=None):
         """
         suffixes, cities and streets provide a chance to use different lists than the provided lists.
         suffixes is probably good for most users, unless you have some suffixes not recognized by USPS.
@@ -52,33 +97,94 @@ class AddressParser(object):
         streets can be used to limit the list of possible streets the address are on. It comes blank by default and
         uses positional clues instead. If you are instead just doing a couple cities, a list of all possible streets
         will decrease incorrect street names.
-        Valid backends include "default" and "dstk". If backend is dstk, it requires a dstk_api_base. Example of
-        dstk_api_base would be 'http://example.com'.
+        Valid backends include "default", "dstk", "local" and "hybrid". If backend is dstk, it requires a dstk_api_base.
+        Example of dstk_api_base would be 'http://example.com'. The local backend parses like the default backend and
+        then sets lat and lng by interpolating along the address ranges in geocoder_file, without any network calls.
+        See LocalGeocoder.load_ranges for the file format. The hybrid backend also requires a dstk_api_base. It
+        parses locally first and only asks DSTK about addresses whose Address.local_confidence() is below
+        required_local_confidence.
+        zip_states maps three digit zip prefixes to two letter states, and is loaded from zip3.csv by default. It lets
+        the default backend fill in a missing state and reject addresses whose zip and state disagree. zip_cities
+        optionally maps five digit zips to their primary city, used to fill in a missing city. It is empty by default.
+        dstk_options are passed on to dstk.DSTK, e.g. {'timeout': 5, 'retries': 1, 'hedgeApiBase': 'http://b.example.com'}.
+        If dstk_fallback is True, addresses are parsed with the default backend while DSTK is unreachable or its
+        circuit breaker is open, instead of raising dstk.DSTKUnavailableError.
+        text_native keeps every Address field as text instead of UTF-8 encoded bytes, and shares one object for each
+        canonical value such as "St." or "WI". It defaults to on for Python 3, where it is required and False raises
+        ValueError, and off for Python 2, where it changes the field types from str to unicode.
+        record_spans makes the default parser record, in Address.spans, the (start, end) offsets in the string passed
+        in that each field was parsed from, e.g. for highlighting. Offsets count characters of a unicode input and
+        bytes of a byte string. Address.span_text(field) slices them out on demand. The normalized fields, such as
+        street_suffix "St.", are still set while parsing, since later checks read the fields found so far.
+        max_length and max_tokens bound the characters and whitespace separated tokens accepted in one address, so a
+        scraped paragraph can't stall a batch. Longer input raises AddressTooLongException. time_budget, in seconds,
+        limits the time spent parsing one address locally; past it ParseTimeoutException is raised. DSTK requests have
+        their own limits through dstk_options. Use None to turn any of these off.
+        cities_dir is a directory of per state city lists, e.g. WI.csv with one city per line, as written by
+        create_cities_csv. Each state's list is loaded the first time an address in that state is parsed, and then
+        only that state's cities are matched. With a cities_dir the flat cities.csv isn't loaded unless cities is
+        given. The bundled cities.csv has no states, so without a cities_dir the whole list is still loaded at
+        startup; the memory and startup savings need a cities_dir generated by create_cities_csv from census data.
         """
         self.logger = logger
         self.backend = backend
         self.dstk_api_base = dstk_api_base
         self.required_confidence = required_confidence
-        if suffixes:
-            self.suffixes = suffixes
-        else:
+        self.required_local_confidence = required_local_confidence
+        self.dstk_fallback = dstk_fallback
+        if text_native is None:
+            text_native = sys.version_info[0] >= 3
+        elif not text_native and sys.version_info[0] >= 3:
+            raise ValueError("text_native can't be turned off on Python 3.")
+        self.text_native = text_native
+        self.record_spans = record_spans
+        self.max_length = max_length
+        self.max_tokens = max_tokens
+        self.time_budget = time_budget
+        # Shared text for every state name and code and every prefix, keyed the way check_state and
+        # check_street_prefix look them up, so fields are assigned without building new strings. Suffixes depend on
+        # the lexicon and are kept in Lexicon.canonical_suffixes.
+        codes = dict((code, text_type(code)) for code in self.states.values())
+        self.canonical_states = dict(codes)
+        self.canonical_states.update((name, codes[code]) for name, code in self.states.items())
+        prefixes = dict((prefix, text_type(prefix)) for prefix in self.prefixes.values())
+        self.canonical_prefixes = dict((key, prefixes[prefix]) for key, prefix in self.prefixes.items())
+        # Multi word state names for looks_like_address, matched as whole phrases so "new" or "of" alone don't count
+        self.state_phrase_regex = re.compile(r'\b(?:' + '|'.join(
+            re.escape(state.lower()) for state in sorted(self.states) if ' ' in state) + r')\b')
+        self.lexicon = Lexicon(suffixes=suffixes or None, cities=cities or None, streets=streets or None,
+                               cities_dir=cities_dir)
+        if not suffixes:
             self.load_suffixes(os.path.join(cwd, "suffixes.csv"))
-        if cities:
-            self.cities = cities
-        else:
+        if not cities and cities_dir is None:
             self.load_cities(os.path.join(cwd, "cities.csv"))
-        if streets:
-            self.streets = streets
-        else:
+        if not streets:
             self.load_streets(os.path.join(cwd, "streets.csv"))
-        if backend == "dstk":
+        if zip_states:
+            self.zip_states = zip_states
+        else:
+            self.zip_states = {}
+            self.load_zip_states(os.path.join(cwd, "zip3.csv"))
+        if zip_cities:
+            self.zip_cities = zip_cities
+        else:
+            self.zip_cities = {}
+        if backend in ("dstk", "hybrid"):
             if dstk_api_base is None:
-                raise ValueError("dstk_api_base is required for dstk backend.")
-            self.dstk = dstk.DSTK({'apiBase': dstk_api_base})
+                raise ValueError("dstk_api_base is required for {0} backend.".format(backend))
+            # One pooled transport, so threads sharing this parser reuse each other's connections. Anything in
+            # dstk_options, including apiBase, overrides these.
+            options = {'transport': PooledTransport(), 'apiBase': dstk_api_base}
+            options.update(dstk_options or {})
+            self.dstk = dstk.DSTK(options)
+        elif backend == "local":
+            if geocoder_file is None:
+                raise ValueError("geocoder_file is required for local backend.")
+            self.geocoder = LocalGeocoder(self, geocoder_file)
         elif backend == "default":
             pass
         else:
-            raise ValueError("backend must be either 'default' or 'dstk'.")
+            raise ValueError("backend must be one of 'default', 'dstk', 'local' or 'hybrid'.")
 
     def parse_address(self, address, line_number=-1):
         """
@@ -87,61 +193,247 @@ class AddressParser(object):
         """
         return Address(address, self, line_number, self.logger)
 
+    def looks_like_address(self, address):
+        """
+        A cheap pre-screen for bulk input: True if the string has a token starting with a digit and a known street
+        suffix or state. Multi word state names only count as whole phrases, and state codes only in upper case, so
+        "new" or "in" in running text doesn't pass. Strings like "Call for pricing" fail in a couple of regex scans,
+        without preprocessing, the check_* chain or an exception. It can reject real but sparse addresses such as
+        "230 Lakelawn", so it is only used where asked for.
+        """
+        if not address or not digit_token_regex.search(address):
+            return False
+        lexicon = self.lexicon
+        if lexicon.screen_words is None:
+            lexicon.screen_words = self._build_screen_words(lexicon)
+        screen_words = lexicon.screen_words
+        for word in word_regex.findall(address.lower()):
+            if word in screen_words:
+                return True
+        for code in state_code_regex.findall(address):
+            if code in screen_words:
+                return True
+        return self.state_phrase_regex.search(address.lower()) is not None
+
+    def _build_screen_words(self, lexicon):
+        words = set()
+        for suffix, abbreviation in lexicon.suffixes.items():
+            words.add(suffix.lower())
+            words.add(abbreviation.lower())
+        for state, abbreviation in self.states.items():
+            if ' ' not in state:
+                words.add(state.lower())
+            words.add(abbreviation)
+        return frozenset(words)
+
+    def parse_addresses(self, address_list, prescreen=False, stats=None):
+        """
+        Parse a list of addresses with parse_address. Returns a list aligned with address_list, holding None for
+        addresses that failed to parse. With prescreen, strings failing looks_like_address are skipped without a
+        full parse. If a stats dictionary is given, the counts of 'parsed', 'invalid' and 'skipped' addresses are
+        added to it.
+        """
+        parsed = []
+        counts = {'parsed': 0, 'invalid': 0, 'skipped': 0}
+        for line_number, address in enumerate(address_list):
+            if prescreen and not self.looks_like_address(address):
+                counts['skipped'] += 1
+                parsed.append(None)
+                continue
+            try:
+                parsed.append(self.parse_address(address, line_number))
+                counts['parsed'] += 1
+            except InvalidAddressException:
+                counts['invalid'] += 1
+                parsed.append(None)
+        if self.logger: self.logger.debug("Parsed {parsed}, invalid {invalid}, skipped {skipped}".format(**counts))
+        if stats is not None:
+            for key, count in counts.items():
+                stats[key] = stats.get(key, 0) + count
+        return parsed
+
     def dstk_multi_address(self, address_list):
-        if self.backend != "dstk":
+        """
+        Parse a batch of addresses through DSTK with a single street2coordinates call. For the hybrid backend,
+        addresses the local parser is confident about are parsed locally and only the rest are sent to DSTK.
+        """
+        return list(self.dstk_multi_address_iter(address_list))
+
+    def dstk_multi_address_iter(self, address_list):
+        """
+        Generator version of dstk_multi_address. The DSTK response is decoded as it arrives and each Address is
+        yielded as soon as its result has been read, so large batches run in bounded memory.
+        """
+        if self.backend not in ("dstk", "hybrid"):
             raise ValueError("Only allowed for DSTK backends.")
+        if self.backend == "hybrid":
+            escalated = []
+            for address in address_list:
+                try:
+                    yield Address(address, self, -1, self.logger, escalate=False)
+                except (AddressTooLongException, ParseTimeoutException):
+                    # Failed outright, not worth a DSTK call
+                    continue
+                except (InvalidAddressException, LocalConfidenceTooLowException):
+                    escalated.append(address)
+            if self.logger: self.logger.debug("Parsed {0} addresses locally".format(len(address_list) - len(escalated)))
+            address_list = escalated
+            if not address_list:
+                return
         if self.logger: self.logger.debug("Sending {0} possible addresses to DSTK".format(len(address_list)))
-        multi_address = self.dstk.street2coordinates(address_list)
-        if self.logger: self.logger.debug("Received {0} addresses from DSTK".format(len(multi_address)))
+        try:
+            multi_address = self.dstk.street2coordinates_stream(address_list)
+        except dstk.DSTKUnavailableError:
+            if not self.dstk_fallback:
+                raise
+            if self.logger: self.logger.debug("DSTK unavailable, parsing {0} addresses locally".format(len(address_list)))
+            for address in address_list:
+                try:
+                    yield Address(address, self, -1, self.logger)
+                except InvalidAddressException:
+                    continue
+            return
         # if self.logger: self.logger.debug("End street2coords")
-        addresses = []
-        # if self.logger: self.logger.debug("Multi Addresses: {0}".format(multi_address))
-        for address, dstk_return in multi_address.items():
+        received = 0
+        for address, dstk_return in multi_address:
+            received += 1
             try:
                 if dstk_return is None:
                     # if self.logger: self.logger.debug("DSTK None return for: {0}".format(address))
                     continue
-                addresses.append(Address(address, self, -1, self.logger, dstk_pre_parse=dstk_return))
+                parsed = Address(address, self, -1, self.logger, dstk_pre_parse=dstk_return)
                 if self.logger: self.logger.debug("DSTK Address Appended: {0}".format(dstk_return))
             except InvalidAddressException as e:
                 # if self.logger: self.logger.debug("Error from dstk Address: {0}".format(e.message))
                 continue
             except DSTKConfidenceTooLowException as e:
                 continue
-        return addresses
+            yield parsed
+        if self.logger: self.logger.debug("Received {0} addresses from DSTK".format(received))
+
+    def freeze(self):
+        """
+        Make the lexicon immutable for sharing between threads, filling everything it would otherwise build while
+        parsing. Cities and streets become frozensets, which also makes each membership check a hash lookup.
+        Returns the parser.
+        """
+        self.lexicon.freeze()
+        self.lexicon.screen_words = self._build_screen_words(self.lexicon)
+        self.frozen = True
+        return self
+
+    def _check_not_frozen(self):
+        if self.frozen:
+            raise ValueError("Can't load into a frozen AddressParser.")
+
+    def swap_lexicon(self, lexicon):
+        """
+        Replace the lexicon with one reference assignment and return the old one. Addresses being parsed keep
+        using the lexicon they started with. A frozen parser freezes the new lexicon before it goes live.
+        """
+        if self.frozen:
+            lexicon.freeze()
+            lexicon.screen_words = self._build_screen_words(lexicon)
+        old, self.lexicon = self.lexicon, lexicon
+        if self.logger: self.logger.debug("Swapped in a new lexicon")
+        return old
+
+    def reload_lexicon(self, suffixes_file=None, cities_file=None, streets_file=None, cities_dir=None):
+        """
+        Build a new lexicon off to the side from the given files, keeping the current lists for any not given, and
+        swap it in. cities_dir replaces the per state city directory, and drops the state lists loaded so far.
+        Returns the old lexicon.
+        """
+        fields = {}
+        if suffixes_file is not None:
+            fields['suffixes'] = {}
+        if cities_file is not None:
+            fields['cities'] = []
+            fields['state_cities'] = {}
+        if streets_file is not None:
+            fields['streets'] = []
+        if cities_dir is not None:
+            fields['cities_dir'] = cities_dir
+        lexicon = self.lexicon.copy(**fields)
+        if suffixes_file is not None:
+            lexicon.load_suffixes(suffixes_file)
+        if cities_file is not None:
+            lexicon.load_cities(cities_file, self.states.values())
+        if streets_file is not None:
+            lexicon.load_streets(streets_file)
+        return self.swap_lexicon(lexicon)
 
+    # The lexicon's lists, kept as parser attributes. Assigning one swaps in a copy of the lexicon with it replaced.
+    suffixes = property(lambda self: self.lexicon.suffixes,
+                        lambda self, value: self.swap_lexicon(self.lexicon.copy(suffixes=value)))
+    cities = property(lambda self: self.lexicon.cities,
+                      lambda self, value: self.swap_lexicon(self.lexicon.copy(cities=value)))
+    streets = property(lambda self: self.lexicon.streets,
+                       lambda self, value: self.swap_lexicon(self.lexicon.copy(streets=value)))
+    state_cities = property(lambda self: self.lexicon.state_cities)
+    cities_dir = property(lambda self: self.lexicon.cities_dir)
 
     def load_suffixes(self, filename):
         """
-        Build the suffix dictionary. The keys will be possible long versions, and the values will be the
-        accepted abbreviations. Everything should be stored using the value version, and you can search all
-        by using building a set of self.suffixes.keys() and self.suffixes.values().
+        Add suffixes from a "LONG,ABBREVIATION" file to the current lexicon. See Lexicon.load_suffixes.
         """
-        with open(filename, 'r') as f:
-            for line in f:
-                # Make sure we have key and value
-                if len(line.split(',')) != 2:
-                    continue
-                    # Strip off newlines.
-                self.suffixes[line.strip().split(',')[0]] = line.strip().split(',')[1]
+        self._check_not_frozen()
+        self.lexicon.load_suffixes(filename)
 
     def load_cities(self, filename):
         """
-        Load up all cities in lowercase for easier matching. The file should have one city per line, with no extra
-        characters. This isn't strictly required, but will vastly increase the accuracy.
+        Add cities to the current lexicon. See Lexicon.load_cities.
+        """
+        self._check_not_frozen()
+        self.lexicon.load_cities(filename, self.states.values())
+
+    def load_streets(self, filename):
+        """
+        Add streets to the current lexicon. See Lexicon.load_streets.
+        """
+        self._check_not_frozen()
+        self.lexicon.load_streets(filename)
+
+    def cities_for_state(self, state):
+        return self.lexicon.cities_for_state(state)
+
+    def is_city(self, city, state=None):
+        return self.lexicon.is_city(city, state)
+
+    def load_zip_states(self, filename):
         """
+        Load ZIP3 prefix ranges. Each line should be "low,high,state", e.g. "530,549,WI". The ranges are expanded into
+        a dictionary keyed by three digit prefix so lookups are a single dictionary access.
+        """
+        self._check_not_frozen()
         with open(filename, 'r') as f:
             for line in f:
-                self.cities.append(line.strip().lower())
+                # Make sure we have low, high and state
+                if len(line.split(',')) != 3:
+                    continue
+                low, high, state = line.strip().split(',')
+                for prefix in range(int(low), int(high) + 1):
+                    self.zip_states["{0:03d}".format(prefix)] = state
 
-    def load_streets(self, filename):
+    def load_zip_cities(self, filename):
         """
-        Load up all streets in lowercase for easier matching. The file should have one street per line, with no extra
-        characters. This isn't strictly required, but will vastly increase the accuracy.
+        Load primary cities for five digit zips. Each line should be "zip,city", e.g. "53703,Madison".
         """
+        self._check_not_frozen()
         with open(filename, 'r') as f:
             for line in f:
-                self.streets.append(line.strip().lower())
+                if len(line.split(',')) != 2:
+                    continue
+                zip_code, city = line.strip().split(',')
+                self.zip_cities[zip_code] = city
+
+    def state_for_zip(self, zip_code):
+        """
+        Return the two letter state a zip code belongs to, or None if its three digit prefix is unknown.
+        """
+        if zip_code is None:
+            return None
+        return self.zip_states.get(zip_code[:3])
 
 
 # Procedure: Go through backwards. First check for apartment number, then
@@ -159,7 +451,7 @@ class Address:
     state = None
     zip = None
     original = None
-    # Only set for dstk
+    # Only set for dstk and local
     lat = None
     lng = None
     last_matched = None
@@ -168,27 +460,59 @@ class Address:
     line_number = -1
     # Confidence value from DSTK. 0 - 1, -1 for not set.
     confidence = -1
+    # Set when guess_unmatched had to guess the street
+    guessed = False
+    # Field name -> (start, end) offsets into source, only when the parser records spans
+    spans = None
+    # The input exactly as given, before _clean may encode it, only when the parser records spans
+    source = None
+    # time.time() past which local parsing gives up, when the parser has a time_budget
+    deadline = None
+    # The parser's Lexicon when parsing started
+    lexicon = None
 
-    def __init__(self, address, parser, line_number=-1, logger=None, dstk_pre_parse=None):
+    def __init__(self, address, parser, line_number=-1, logger=None, dstk_pre_parse=None, escalate=True):
         """
         @dstk_pre_parse: a single value from a dstk multiple street2coordinates return. @address would be the key then.
+        @escalate: for the hybrid backend, whether a low confidence local parse is sent to DSTK. If False,
+        LocalConfidenceTooLowException is raised instead, so the caller can batch the DSTK calls.
         """
         self.parser = parser
+        # Keep one lexicon for the whole parse, even if the parser's is swapped meanwhile
+        self.lexicon = parser.lexicon
         self.line_number = line_number
         self.original = self._clean(address)
         self.logger = logger
+        if parser.record_spans:
+            self.spans = {}
+            self.source = address
         if address is None:
             return
+        if parser.max_length is not None and len(address) > parser.max_length:
+            raise AddressTooLongException("Addresses are limited to {0} characters.".format(parser.max_length))
+        if parser.max_tokens is not None and len(address.split()) > parser.max_tokens:
+            raise AddressTooLongException("Addresses are limited to {0} tokens.".format(parser.max_tokens))
+        if parser.time_budget is not None:
+            self.deadline = time.time() + parser.time_budget
         address = self.preprocess_address(address)
+        self.check_deadline()
         if parser.backend == "dstk":
             # if self.logger: self.logger.debug("Preparsed: {0}".format(dstk_pre_parse))
-            self.dstk_parse(address, parser, pre_parsed_address=dstk_pre_parse)
+            self.dstk_parse_or_fallback(address, parser, pre_parsed_address=dstk_pre_parse)
         elif parser.backend == "default":
             self.parse_address(address)
+        elif parser.backend == "local":
+            self.parse_address(address)
+            parser.geocoder.geocode(self)
+        elif parser.backend == "hybrid":
+            if dstk_pre_parse is not None or not self.hybrid_parse(address):
+                if dstk_pre_parse is None and not escalate:
+                    raise LocalConfidenceTooLowException("Local parse not confident enough, address: {0}".format(self.original))
+                self.dstk_parse_or_fallback(address, parser, pre_parsed_address=dstk_pre_parse)
         else:
-            raise ValueError("Parser gave invalid backend, must be either 'default' or 'dstk'.")
+            raise ValueError("Parser gave invalid backend, must be one of 'default', 'dstk', 'local' or 'hybrid'.")
 
-        if self.house_number is None or self.house_number <= 0:
+        if not self.house_number:
             raise InvalidAddressException("Addresses must have house numbers.")
         elif self.street is None or self.street == "":
             raise InvalidAddressException("Addresses must have streets.")
@@ -199,53 +523,171 @@ class Address:
         # print "YOU ARE PARSING AN ADDRESS"
         # Save the original string
 
-        # Get rid of periods and commas, split by spaces, reverse.
-        # Periods should not exist, remove them. Commas separate tokens. It's possible we can use commas for better guessing.
-        address = address.strip().replace('.', '')
-        # We'll use this for guessing.
-        self.comma_separated_address = address.split(',')
-        address = address.replace(',', '')
+        if self.spans is not None:
+            # One scan for tokens and their offsets, see token_spans. Only the comma count is used for guessing.
+            self.comma_separated_address = address.split(',')
+            address = self.token_spans(address)
+        else:
+            # Get rid of periods and commas, split by spaces, reverse.
+            # Periods should not exist, remove them. Commas separate tokens. It's possible we can use commas for better guessing.
+            address = address.strip().replace('.', '')
+            # We'll use this for guessing.
+            self.comma_separated_address = address.split(',')
+            address = address.replace(',', '')
 
-        # First, do some preprocessing
-        # address = self.preprocess_address(address)
+            # First, do some preprocessing
+            # address = self.preprocess_address(address)
 
-        # Try all our address regexes. USPS says parse from the back.
-        address = reversed(address.split())
+            # Try all our address regexes. USPS says parse from the back.
+            address = ((token, None) for token in reversed(address.split()))
         # Save unmatched to process after the rest is processed.
         unmatched = []
         # Use for contextual data
-        for token in address:
+        for token, span in address:
         #            print token, self
-            # Check zip code first
-            if self.check_zip(token):
-                continue
-            if self.check_state(token):
-                continue
-            if self.check_city(token):
-                continue
-            if self.check_street_suffix(token):
-                continue
-            if self.check_house_number(token):
-                continue
-            if self.check_street_prefix(token):
+            self.check_deadline()
+            field = self.check_token(token)
+            if field:
+                if span is not None and field is not True:
+                    self.record_span(field, span)
                 continue
-            if self.check_street(token):
-                continue
-                # if self.check_building(token):
-            #     continue
-            if self.guess_unmatched(token):
-                continue
-            unmatched.append(token)
+            unmatched.append((token, span))
 
         # Post processing
 
-        for token in unmatched:
+        for token, span in unmatched:
         #            print "Unmatched token: ", token
+            self.check_deadline()
             if self.check_apartment_number(token):
+                if span is not None:
+                    self.record_span('apartment', span)
                 continue
                 # print "Unmatched token: ", token
             #            print "Original address: ", self.original
             self.unmatched = True
+        self.check_zip_state()
+
+    def check_deadline(self):
+        """
+        Raise ParseTimeoutException once the parser's time_budget for this address is spent.
+        """
+        if self.deadline is not None and time.time() > self.deadline:
+            raise ParseTimeoutException("Parsing took longer than {0} seconds, address: {1}".format(
+                self.parser.time_budget, self.original))
+
+    def check_token(self, token):
+        """
+        Run a token through the checks in order. Returns the name of the field that used it, True if it was used
+        without filling a field, or False.
+        """
+        # Check zip code first
+        if self.check_zip(token):
+            return 'zip'
+        if self.check_state(token):
+            return 'state'
+        if self.check_city(token):
+            return 'city'
+        if self.check_street_suffix(token):
+            return 'street_suffix'
+        if self.check_house_number(token):
+            return 'house_number'
+        if self.check_street_prefix(token):
+            return 'street_prefix'
+        if self.check_street(token):
+            return 'street'
+            # if self.check_building(token):
+        #     return True
+        street = self.street
+        if self.guess_unmatched(token):
+            # Stray dashes are used up without becoming part of the street
+            return 'street' if self.street is not street else True
+        return False
+
+    def token_spans(self, address):
+        """
+        Tokenize the preprocessed address in one scan, yielding (token, (start, end)) from the last token to the
+        first, with periods and commas dropped from the tokens. The same tokens as the split used without spans.
+        Preprocessing only deletes characters, so when it left the address as long as the original the offsets are
+        already offsets into source. Otherwise each token is found in source, right to left, and tokens
+        preprocessing rewrote, such as "#5" from "# 5", get a span of None.
+        """
+        matches = list(span_token_regex.finditer(address))
+        unchanged = len(address) == len(self.source)
+        right = len(self.source)
+        for match in reversed(matches):
+            text = match.group()
+            token = text.replace('.', '').replace(',', '') if '.' in text or ',' in text else text
+            if unchanged:
+                yield token, match.span()
+                continue
+            start = self.source.rfind(text, 0, right)
+            if start < 0:
+                yield token, None
+                continue
+            right = start
+            yield token, (start, start + len(text))
+
+    def record_span(self, field, span):
+        """
+        Give span to the field, growing the field's span for multi word values.
+        """
+        if field in self.spans:
+            start, end = self.spans[field]
+            span = (min(start, span[0]), max(end, span[1]))
+        self.spans[field] = span
+
+    def span_text(self, field):
+        """
+        The part of the input a field was parsed from, sliced only when asked for, with the input's type. None if
+        the field was not found in the input, or spans are not being recorded.
+        """
+        if not self.spans or field not in self.spans:
+            return None
+        start, end = self.spans[field]
+        return self.source[start:end]
+
+    def hybrid_parse(self, address):
+        """
+        Parse locally and keep the result if it is confident enough for the parser. Otherwise reset the parsed
+        fields, keeping the apartment found during preprocessing, and return False so DSTK can take over.
+        """
+        apartment = self.apartment
+        try:
+            self.parse_address(address)
+            if self.house_number is not None and self.street and \
+                    self.local_confidence() >= self.parser.required_local_confidence:
+                return True
+        except ParseTimeoutException:
+            raise
+        except InvalidAddressException:
+            pass
+        for field in ('unmatched', 'guessed', 'house_number', 'street_prefix', 'street', 'street_suffix', 'apartment',
+                      'city', 'state', 'zip', 'last_matched'):
+            self.__dict__.pop(field, None)
+        self.apartment = apartment
+        if self.spans:
+            self.spans = dict((field, span) for field, span in self.spans.items() if field == 'apartment')
+        return False
+
+    def local_confidence(self):
+        """
+        A cheap 0 - 1 confidence for a default backend parse, built from what the parser already knows. Unmatched
+        tokens and guessed streets cost the most, then each missing suffix, city, state or zip.
+        """
+        confidence = 1.0
+        if self.unmatched:
+            confidence -= 0.4
+        if self.guessed:
+            confidence -= 0.2
+        if self.street_suffix is None:
+            confidence -= 0.15
+        if self.city is None:
+            confidence -= 0.1
+        if self.state is None:
+            confidence -= 0.1
+        if self.zip is None:
+            confidence -= 0.05
+        return max(confidence, 0.0)
 
     def preprocess_address(self, address):
         """
@@ -256,8 +698,7 @@ class Address:
         address = address.replace("# ", "#")
         address = address.replace(" & ", "&")
         # Clear the address of things like 'X units', which shouldn't be in an address anyway. We won't save this for now.
-        if re.search(r"-?-?\w+ units", address, re.IGNORECASE):
-            address = re.sub(r"-?-?\w+ units", "", address, flags=re.IGNORECASE)
+        address = units_regex.sub("", address)
             # Sometimes buildings are put in parantheses.
         # building_match = re.search(r"\(.*\)", address, re.IGNORECASE)
         # if building_match:
@@ -265,15 +706,16 @@ class Address:
         #     address = re.sub(r"\(.*\)", "", address, flags=re.IGNORECASE)
         # Now let's get the apartment stuff out of the way. Using only sure match regexes, delete apartment parts from
         # the address. This prevents things like "Unit" being the street name.
-        apartment_regexes = [r'#\w+ & \w+', '#\w+ rm \w+', "#\w+-\w", r'apt #{0,1}\w+', r'apartment #{0,1}\w+', r'#\w+',
-                             r'# \w+', r'rm \w+', r'unit #?\w+', r'units #?\w+', r'- #{0,1}\w+', r'no\s?\d+\w*',
-                             r'style\s\w{1,2}', r'townhouse style\s\w{1,2}']
         for regex in apartment_regexes:
-            apartment_match = re.search(regex, address, re.IGNORECASE)
+            apartment_match = regex.search(address)
             if apartment_match:
             #                print "Matched regex: ", regex, apartment_match.group()
                 self.apartment = self._clean(apartment_match.group())
-                address = re.sub(regex, "", address, flags=re.IGNORECASE)
+                if self.spans is not None:
+                    start = self.source.find(apartment_match.group())
+                    if start >= 0:
+                        self.spans['apartment'] = (start, start + len(apartment_match.group()))
+                address = regex.sub("", address)
             # Now check for things like ",  ," which throw off dstk
         address = re.sub(r"\,\s*\,", ",", address)
         return address
@@ -294,24 +736,36 @@ class Address:
                 return True
         return False
 
+    def check_zip_state(self):
+        """
+        Cross check the zip against the state using the parser's ZIP3 table, without any network call. Fills in a
+        missing state (and city, if the parser knows the zip's primary city) and rejects mismatched zips and states.
+        """
+        zip_state = self.parser.state_for_zip(self.zip)
+        if zip_state is None:
+            return
+        if self.state is None:
+            state = self.parser.canonical_states.get(zip_state)
+            self.state = self._clean(state, canonical=True) if state is not None else self._clean(zip_state)
+        elif self.state != zip_state:
+            raise InvalidAddressException("Zip code {0} is not in state {1}.".format(self.zip, self.state))
+        if self.city is None and self.zip in self.parser.zip_cities:
+            self.city = self._clean(self.parser.zip_cities[self.zip])
+
     def check_state(self, token):
         """
         Check if state is in either the keys or values of our states list. Must come before the suffix.
         """
         # print "zip", self.zip
-        if len(token) == 2 and self.state is None:
-            if token.capitalize() in self.parser.states.keys():
-                self.state = self._clean(self.parser.states[token.capitalize()])
-                return True
-            elif token.upper() in self.parser.states.values():
-                self.state = self._clean(token.upper())
-                return True
-        if self.state is None and self.street_suffix is None and len(self.comma_separated_address) > 1:
-            if token.capitalize() in self.parser.states.keys():
-                self.state = self._clean(self.parser.states[token.capitalize()])
-                return True
-            elif token.upper() in self.parser.states.values():
-                self.state = self._clean(token.upper())
+        if self.state is None and (len(token) == 2 or
+                                   (self.street_suffix is None and len(self.comma_separated_address) > 1)):
+            # Names are keyed capitalized and codes upper case, so neither lookup can match the other
+            states = self.parser.canonical_states
+            state = states.get(token.capitalize())
+            if state is None:
+                state = states.get(token.upper())
+            if state is not None:
+                self.state = self._clean(state, canonical=True)
                 return True
         return False
 
@@ -320,28 +774,30 @@ class Address:
         Check if there is a known city from our city list. Must come before the suffix.
         """
         shortened_cities = {'saint': 'st.'}
+        # Limit the match to the cities of the state found so far, or the state the zip belongs to
+        state = self.state or self.parser.state_for_zip(self.zip)
         if self.city is None and self.state is not None and self.street_suffix is None:
-            if token.lower() in self.parser.cities:
+            if self.lexicon.is_city(token.lower(), state):
                 self.city = self._clean(token.capitalize())
                 return True
             return False
             # Check that we're in the correct location, and that we have at least one comma in the address
         if self.city is None and self.apartment is None and self.street_suffix is None and len(
                 self.comma_separated_address) > 1:
-            if token.lower() in self.parser.cities:
+            if self.lexicon.is_city(token.lower(), state):
                 self.city = self._clean(token.capitalize())
                 return True
             return False
         # Multi word cities
         if self.city is not None and self.street_suffix is None and self.street is None:
-            print "Checking for multi part city", token.lower(), token.lower() in shortened_cities.keys()
-            if token.lower() + ' ' + self.city in self.parser.cities:
+            print("Checking for multi part city", token.lower(), token.lower() in shortened_cities.keys())
+            if self.lexicon.is_city(token.lower() + ' ' + self.city.lower(), state):
                 self.city = self._clean((token.lower() + ' ' + self.city).capitalize())
                 return True
             if token.lower() in shortened_cities.keys():
                 token = shortened_cities[token.lower()]
-                print "Checking for shorted multi part city", token.lower() + ' ' + self.city
-                if token.lower() + ' ' + self.city.lower() in self.parser.cities:
+                print("Checking for shorted multi part city", token.lower() + ' ' + self.city)
+                if self.lexicon.is_city(token.lower() + ' ' + self.city.lower(), state):
                     self.city = self._clean(token.capitalize() + ' ' + self.city.capitalize())
                     return True
 
@@ -350,11 +806,8 @@ class Address:
         Finds apartment, unit, #, etc, regardless of spot in string. This needs to come after everything else has been ruled out,
         because it has a lot of false positives.
         """
-        apartment_regexes = [r'#\w+ & \w+', '#\w+ rm \w+', "#\w+-\w", r'apt #{0,1}\w+', r'apartment #{0,1}\w+', r'#\w+',
-                             r'# \w+', r'rm \w+', r'unit #?\w+', r'units #?\w+', r'- #{0,1}\w+', r'no\s?\d+\w*',
-                             r'style\s\w{1,2}', r'\d{1,4}/\d{1,4}', r'\d{1,4}', r'\w{1,2}']
-        for regex in apartment_regexes:
-            if re.match(regex, token.lower()):
+        for regex in apartment_token_regexes:
+            if regex.match(token.lower()):
                 self.apartment = self._clean(token)
                 return True
             #        if self.apartment is None and re.match(apartment_regex_number, token.lower()):
@@ -383,12 +836,12 @@ class Address:
         # print "Suffix check", token, "suffix", self.street_suffix, "street", self.street
         if self.street_suffix is None and self.street is None:
             # print "upper", token.upper()
-            if token.upper() in self.parser.suffixes.keys():
-                suffix = self.parser.suffixes[token.upper()]
-                self.street_suffix = self._clean(suffix.capitalize() + '.')
-                return True
-            elif token.upper() in self.parser.suffixes.values():
-                self.street_suffix = self._clean(token.capitalize() + '.')
+            suffixes = self.lexicon.canonical_suffixes
+            if suffixes is None:
+                suffixes = self.lexicon.build_canonical_suffixes()
+            suffix = suffixes.get(token.upper())
+            if suffix is not None:
+                self.street_suffix = self._clean(suffix, canonical=True)
                 return True
         return False
 
@@ -407,7 +860,7 @@ class Address:
         elif self.street is not None and self.street_suffix is not None and self.street_prefix is None and self.house_number is None:
             self.street = self._clean(token.capitalize() + ' ' + self.street)
             return True
-        if not self.street_suffix and not self.street and token.lower() in self.parser.streets:
+        if not self.street_suffix and not self.street and token.lower() in self.lexicon.streets:
             self.street = self._clean(token)
             return True
         return False
@@ -417,9 +870,11 @@ class Address:
         Finds street prefixes, such as N. or Northwest, before a street name. Standardizes to 1 or two letters, followed
         by a period.
         """
-        if self.street and not self.street_prefix and token.lower().replace('.', '') in self.parser.prefixes.keys():
-            self.street_prefix = self._clean(self.parser.prefixes[token.lower().replace('.', '')])
-            return True
+        if self.street and not self.street_prefix:
+            prefix = self.parser.canonical_prefixes.get(token.lower().replace('.', ''))
+            if prefix is not None:
+                self.street_prefix = self._clean(prefix, canonical=True)
+                return True
         return False
 
     def check_house_number(self, token):
@@ -473,6 +928,7 @@ class Address:
                 #                    print "Guessing suffix-less street: ", token
                     pass
                 self.street = self._clean(token.capitalize())
+                self.guessed = True
                 return True
         return False
 
@@ -501,20 +957,36 @@ class Address:
             addr = addr + " " + self.zip
         return addr
 
-    def _clean(self, item):
+    def _clean(self, item, canonical=False):
+        """
+        Store a field value. Text native parsers keep text; otherwise values are encoded to UTF-8 bytes. canonical
+        values already come from the parser's shared tables and are stored as they are.
+        """
         if item is None:
             return None
+        elif self.parser.text_native:
+            if canonical:
+                return item
+            if isinstance(item, bytes):
+                return item.decode("utf-8", "replace")
+            return item
         else:
             return item.encode("utf-8", "replace")
 
     def __repr__(self):
-        return unicode(self)
+        return str(self)
 
     def __str__(self):
-        return unicode(self)
+        # Encode only here, at the output boundary.
+        if text_type is str:
+            return self.__unicode__()
+        return self.__unicode__().encode("utf-8", "replace")
 
-    def __unicode__(self):
-        address_dict = {
+    def as_dict(self):
+        """
+        The parsed fields as a dictionary, e.g. for JSON output.
+        """
+        return {
             "house_number": self.house_number,
             "street_prefix": self.street_prefix,
             "street": self.street,
@@ -525,10 +997,25 @@ class Address:
             "state": self.state,
             "zip": self.zip
         }
+
+    def __unicode__(self):
+        address_dict = self.as_dict()
         # print "Address Dict", address_dict
         return u"Address - House number: {house_number} Prefix: {street_prefix} Street: {street} Suffix: {street_suffix}" \
                u" Apartment: {apartment} City,State,Zip: {city}, {state} {zip}".format(**address_dict)
 
+    def dstk_parse_or_fallback(self, address, parser, pre_parsed_address=None):
+        """
+        dstk_parse, but fall back to the default backend's parse if DSTK is unavailable and the parser allows it.
+        """
+        try:
+            self.dstk_parse(address, parser, pre_parsed_address=pre_parsed_address)
+        except dstk.DSTKUnavailableError:
+            if not parser.dstk_fallback:
+                raise
+            if self.logger: self.logger.debug("DSTK unavailable, parsing locally: {0}".format(self.original))
+            self.parse_address(address)
+
     def dstk_parse(self, address, parser, pre_parsed_address=None):
         """
         Given an address string, use DSTK to parse the address and then coerce it to a normal Address object.
@@ -539,7 +1026,10 @@ class Address:
             dstk_address = pre_parsed_address
         else:
             if self.logger: self.logger.debug("Asking DSTK for address parse {0}".format(address.encode("ascii", "ignore")))
-            dstk_address = parser.dstk.street2coordinates(address)
+            # street2coordinates returns a dictionary keyed by the address sent
+            dstk_address = parser.dstk.street2coordinates(address).get(address)
+            if dstk_address is None:
+                raise InvalidAddressException("DSTK could not parse address: {0}".format(self.original))
             # if self.logger: self.logger.debug("dstk return: {0}".format(dstk_address))
         if 'confidence' not in dstk_address:
             raise InvalidAddressException("Could not deal with DSTK return: {0}".format(dstk_address))
@@ -607,7 +1097,7 @@ class Address:
         if split_addr[0] == self.house_number:
             split_addr = split_addr[1:]
         if self.logger: self.logger.debug("Checking {0} for suffixes".format(split_addr[-1].upper()))
-        if split_addr[-1].upper() in parser.suffixes.keys() or split_addr[-1].upper() in parser.suffixes.values():
+        if split_addr[-1].upper() in self.lexicon.suffixes.keys() or split_addr[-1].upper() in self.lexicon.suffixes.values():
             self.street_suffix = split_addr[-1]
             split_addr = split_addr[:-1]
         if self.logger: self.logger.debug("Checking {0} for prefixes".format(split_addr[0].lower()))
@@ -651,30 +1141,37 @@ class Address:
         """
         Normalize prefixes, suffixes and other to make matching original to returned easier.
         """
-        normalized_address = []
         if self.logger: self.logger.debug("Normalizing Address: {0}".format(address))
-        for token in address.split():
-            if token.upper() in self.parser.suffixes.keys():
-                normalized_address.append(self.parser.suffixes[token.upper()].lower())
-            elif token.upper() in self.parser.suffixes.values():
-                normalized_address.append(token.lower())
-            elif token.upper().replace('.', '') in self.parser.suffixes.values():
-                normalized_address.append(token.lower().replace('.', ''))
-            elif token.lower() in self.parser.prefixes.keys():
-                normalized_address.append(self.parser.prefixes[token.lower()].lower())
-            elif token.upper() in self.parser.prefixes.values():
-                normalized_address.append(token.lower()[:-1])
-            elif token.upper() + '.' in self.parser.prefixes.values():
-                normalized_address.append(token.lower())
-            else:
-                normalized_address.append(token.lower())
-        return normalized_address
+        return [normalize_token(token, self.lexicon.suffixes, self.parser.prefixes) for token in address.split()]
+
+
+def normalize_token(token, suffixes, prefixes):
+    """
+    Normalize one token for matching: suffixes and prefixes become their lower case abbreviations, everything else is
+    lower cased. suffixes and prefixes are the dictionaries of a lexicon and AddressParser.
+    """
+    if token.upper() in suffixes.keys():
+        return suffixes[token.upper()].lower()
+    elif token.upper() in suffixes.values():
+        return token.lower()
+    elif token.upper().replace('.', '') in suffixes.values():
+        return token.lower().replace('.', '')
+    elif token.lower() in prefixes.keys():
+        return prefixes[token.lower()].lower()
+    elif token.upper() in prefixes.values():
+        return token.lower()[:-1]
+    elif token.upper() + '.' in prefixes.values():
+        return token.lower()
+    else:
+        return token.lower()
 
 
-def create_cities_csv(filename="places2k.txt", output="cities.csv"):
+def create_cities_csv(filename="places2k.txt", output="cities.csv", output_dir=None):
     """
-    Takes the places2k.txt from USPS and creates a simple file of all cities.
+    Takes the places2k.txt from USPS and creates a file of all cities as "state,city" lines. If output_dir is given,
+    also writes one file per state there, e.g. WI.csv, for AddressParser's cities_dir.
     """
+    state_cities = {}
     with open(filename, 'r') as city_file:
         with open(output, 'w') as out:
             for line in city_file:
@@ -683,15 +1180,32 @@ def create_cities_csv(filename="places2k.txt", output="cities.csv"):
                     continue
                     # Per census.gov, characters 9-72 are the name of the city or place. Cut ,off the last part, which is city, town, etc.
                 #                    print " ".join(line[9:72].split()[:-1])
-                out.write(" ".join(line[9:72].split()[:-1]) + '\n')
+                # Characters 0-1 are the state code.
+                city = " ".join(line[9:72].split()[:-1])
+                out.write(line[0:2] + ',' + city + '\n')
+                state_cities.setdefault(line[0:2], []).append(city)
+    if output_dir is not None:
+        for state, cities in state_cities.items():
+            with open(os.path.join(output_dir, state + ".csv"), 'w') as out:
+                for city in cities:
+                    out.write(city + '\n')
 
 
 class InvalidAddressException(Exception):
     pass
 
+class AddressTooLongException(InvalidAddressException):
+    pass
+
+class ParseTimeoutException(InvalidAddressException):
+    pass
+
 class DSTKConfidenceTooLowException(Exception):
     pass
 
+class LocalConfidenceTooLowException(Exception):
+    pass
+
 if __name__ == "__main__":
     ap = AddressParser()
-    print ap.parse_address(" ".join(sys.argv[1:]))
+    print(ap.parse_address(" ".join(sys.argv[1:])))
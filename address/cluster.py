@@ -0,0 +1,107 @@
+# Near-duplicate clustering over parsed addresses, e.g. "123 W Mifflin St Apt 10" and "123 West Mifflin, #10".
+
+import re
+from array import array
+
+# Words that only say "this is an apartment", dropped so "Apt 10" and "#10" compare equal
+apartment_words = frozenset(['apt', 'apartment', 'unit', 'units', 'rm', 'no', 'ste', 'suite'])
+
+
+def address_tokens(address):
+    """
+    The normalized street and apartment tokens of a parsed Address, as a frozenset. Prefixes and suffixes are
+    reduced to their abbreviations with Address._normalize, so "West" and "W." are the same token.
+    """
+    street = " ".join(part for part in (address.street_prefix, address.street, address.street_suffix) if part)
+    tokens = set(token.replace('.', '') for token in address._normalize(street))
+    if address.apartment:
+        tokens.update(token for token in re.findall(r'\w+', address.apartment.lower()) if token not in apartment_words)
+    return frozenset(tokens)
+
+
+def similarity(tokens, other_tokens):
+    """
+    Jaccard similarity of two token sets.
+    """
+    if not tokens and not other_tokens:
+        return 1.0
+    return float(len(tokens & other_tokens)) / len(tokens | other_tokens)
+
+
+class AddressClusterer(object):
+    """
+    Groups near-duplicate addresses in a single pass. Addresses are blocked by (zip or city, house number), so only
+    addresses in the same block are ever compared. Each block keeps the tokens of one representative per cluster
+    rather than every address, and each added address costs one integer, so memory grows with the number of
+    distinct addresses, not the number of listings. An address scoring at least threshold against several
+    representatives joins their clusters together through a union-find.
+    """
+
+    def __init__(self, threshold=0.6, max_block_size=1000):
+        """
+        max_block_size caps the representatives kept per block, bounding the comparisons per address. Past it,
+        new clusters in that block are no longer compared against.
+        """
+        self.threshold = threshold
+        self.max_block_size = max_block_size
+        # block key -> list of (cluster id, tokens)
+        self.blocks = {}
+        # Union-find parent of each cluster id
+        self.parents = array('l')
+        # Cluster id each added address joined
+        self.labels = array('l')
+
+    def block_key(self, address):
+        area = address.zip or (address.city.lower() if address.city else '')
+        return (area, address.house_number)
+
+    def add(self, address):
+        """
+        Add a parsed Address. Returns its index, in the order addresses were added.
+        """
+        tokens = address_tokens(address)
+        representatives = self.blocks.setdefault(self.block_key(address), [])
+        cluster = None
+        for cluster_id, other_tokens in representatives:
+            if similarity(tokens, other_tokens) >= self.threshold:
+                if cluster is None:
+                    cluster = self.find(cluster_id)
+                else:
+                    self.union(cluster, cluster_id)
+        if cluster is None:
+            cluster = len(self.parents)
+            self.parents.append(cluster)
+            if len(representatives) < self.max_block_size:
+                representatives.append((cluster, tokens))
+        self.labels.append(cluster)
+        return len(self.labels) - 1
+
+    def find(self, cluster_id):
+        parents = self.parents
+        while parents[cluster_id] != cluster_id:
+            # Path halving
+            parents[cluster_id] = parents[parents[cluster_id]]
+            cluster_id = parents[cluster_id]
+        return cluster_id
+
+    def union(self, cluster_id, other_id):
+        root, other_root = self.find(cluster_id), self.find(other_id)
+        if root != other_root:
+            self.parents[max(root, other_root)] = min(root, other_root)
+
+    def clusters(self):
+        """
+        The final cluster label of every added address, in the order they were added. Addresses with the same
+        label are near-duplicates. Labels are the smallest cluster id in each cluster.
+        """
+        return [self.find(label) for label in self.labels]
+
+
+def cluster_addresses(addresses, threshold=0.6, max_block_size=1000):
+    """
+    Cluster an iterable of parsed Addresses in one pass. Returns a cluster label for each address, in order.
+    """
+    clusterer = AddressClusterer(threshold, max_block_size)
+    for address in addresses:
+        clusterer.add(address)
+    return clusterer.clusters()
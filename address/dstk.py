@@ -19,16 +19,105 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import urllib
+from __future__ import print_function
 try:
     import simplejson as json
 except ImportError:
     import json
 import os
-import httplib
 import mimetypes
 import re
 import csv
+import codecs
+import random
+import socket
+import sys
+import threading
+import time
+from collections import deque
+try:
+    from urllib2 import urlopen
+    import httplib
+    import Queue
+except ImportError:
+    from urllib.request import urlopen
+    import http.client as httplib
+    import queue as Queue
+try:
+    from .transport import UrllibTransport
+except (ImportError, ValueError):
+    # Run as a script
+    from transport import UrllibTransport
+
+
+class DSTKError(Exception):
+    pass
+
+class DSTKUnavailableError(DSTKError):
+    """
+    Raised when the server could not be reached within the retries and deadline, or when the circuit breaker is
+    open because the server has been failing.
+    """
+    pass
+
+
+def coalesce_key(address):
+    """
+    The key duplicate addresses are coalesced on: the address as text with runs of whitespace collapsed. Case is kept,
+    since DSTK's answer is checked against the address it was asked about.
+    """
+    if isinstance(address, bytes):
+        address = address.decode('utf-8')
+    return u" ".join(address.split())
+
+
+class Flight(object):
+    """
+    One street2coordinates lookup in progress, which other threads asking for the same address wait on.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast after failure_threshold consecutive failures. After reset_timeout seconds one trial call is let
+    through; if it succeeds the breaker closes again, otherwise it stays open for another reset_timeout.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_timeout:
+                # Half open: let this call through as the trial and hold everyone else off until it reports back.
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+    def is_open(self):
+        return self.opened_at is not None
 
 
 # This is the main interface class. You can see an example of it in use
@@ -45,9 +134,25 @@ class DSTK:
         if options is None:
             options = {}
 
+        # timeout is per attempt and deadline covers all attempts of one call, both in seconds. Retries back off
+        # exponentially from retryBackoff with jitter. If hedgeApiBase is set, a duplicate request goes to it when
+        # the first one is slower than the hedgePercentile of recent calls, and whichever answers first wins.
+        # transport carries the requests, see transport.py; it defaults to a UrllibTransport. compressRequests,
+        # 'gzip' or 'deflate', compresses request bodies, for servers known to accept them; responses are always
+        # requested compressed. Bytes saved are counted in self.transport.stats.
         defaultOptions = {
             'apiBase': 'http://www.datasciencetoolkit.org',
-            'checkVersion': True
+            'checkVersion': True,
+            'timeout': 30.0,
+            'deadline': 60.0,
+            'retries': 2,
+            'retryBackoff': 0.1,
+            'hedgeApiBase': None,
+            'hedgePercentile': 95,
+            'breakerThreshold': 5,
+            'breakerResetTimeout': 30.0,
+            'transport': None,
+            'compressRequests': None,
         }
 
         if 'DSTK_API_BASE' in os.environ:
@@ -58,6 +163,21 @@ class DSTK:
                 options[key] = value
 
         self.api_base = options['apiBase']
+        self.transport = options['transport'] or UrllibTransport(options['compressRequests'])
+        if options['transport'] and options['compressRequests']:
+            self.transport.compress_requests = options['compressRequests']
+        self.timeout = options['timeout']
+        self.deadline = options['deadline']
+        self.retries = options['retries']
+        self.retry_backoff = options['retryBackoff']
+        self.hedge_api_base = options['hedgeApiBase']
+        self.hedge_percentile = options['hedgePercentile']
+        self.breaker = CircuitBreaker(options['breakerThreshold'], options['breakerResetTimeout'])
+        # Recent successful call latencies, used to decide when to hedge
+        self.latencies = deque(maxlen=200)
+        # coalesce_key -> Flight for street2coordinates lookups in progress
+        self.flights = {}
+        self.flights_lock = threading.Lock()
 
         if options['checkVersion']:
             self.check_version()
@@ -69,25 +189,113 @@ class DSTK:
         api_url = self.api_base+'/info'
 
         try:
-            response_string = urllib.urlopen(api_url).read()
-            response = json.loads(response_string)
-        except:
-            raise Exception('The server at "'+self.api_base+'" doesn\'t seem to be running DSTK, no version information found.')
+            response = self._request('/info')
+            actual_version = response['version']
+        except DSTKUnavailableError:
+            raise
+        except (ValueError, KeyError, TypeError) as e:
+            raise DSTKError('The server at "'+self.api_base+'" doesn\'t seem to be running DSTK, no version information found: '+repr(e))
 
-        actual_version = response['version']
         if actual_version < required_version:
-            raise Exception('DSTK: Version '+str(actual_version)+' found at "'+api_url+'" but '+str(required_version)+' is required')
+            raise DSTKError('DSTK: Version '+str(actual_version)+' found at "'+api_url+'" but '+str(required_version)+' is required')
+
+    def _request(self, endpoint, api_body=None, stream=False):
+        """
+        Call an endpoint and decode the JSON response. Network failures are retried with jittered exponential
+        backoff until retries or the deadline run out, then DSTKUnavailableError is raised. Calls fail fast with
+        DSTKUnavailableError while the circuit breaker is open. With stream=True the open, undecoded response is
+        returned as soon as the server answers; only opening it is retried, and it is never hedged.
+        """
+        if not self.breaker.allow():
+            raise DSTKUnavailableError('DSTK at "'+self.api_base+'" is failing, not sending requests for now.')
+        give_up_at = time.time() + self.deadline
+        attempt = 0
+        while True:
+            timeout = min(self.timeout, give_up_at - time.time())
+            try:
+                if timeout <= 0:
+                    raise socket.timeout('deadline exceeded')
+                if stream:
+                    response = self.transport.open(self.api_base+endpoint, api_body, timeout)
+                else:
+                    response_string = self._fetch(endpoint, api_body, timeout)
+                break
+            except (IOError, httplib.HTTPException) as e:
+                # Transports raise IOErrors; urllib2.URLError, socket.error and socket.timeout all are
+                self.breaker.record_failure()
+                attempt += 1
+                delay = self.retry_backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                if attempt > self.retries or self.breaker.is_open() or time.time() + delay >= give_up_at:
+                    raise DSTKUnavailableError('DSTK request to "'+endpoint+'" failed: '+repr(e))
+                time.sleep(delay)
+        self.breaker.record_success()
+        if stream:
+            return response
+        return json.loads(response_string)
+
+    def _fetch(self, endpoint, api_body, timeout):
+        """
+        Fetch one response body, hedging with a duplicate request to hedgeApiBase if the first is slow.
+        """
+        started = time.time()
+        if self.hedge_api_base is None or len(self.latencies) < 20:
+            response_string = self.transport.request(self.api_base+endpoint, api_body, timeout)
+            self.latencies.append(time.time() - started)
+            return response_string
+
+        ordered = sorted(self.latencies)
+        hedge_after = ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100.0))]
+        answers = Queue.Queue()
+
+        def fetch(api_base):
+            try:
+                answers.put((True, self.transport.request(api_base+endpoint, api_body, timeout)))
+            except Exception as e:
+                answers.put((False, e))
+
+        def hedge():
+            worker = threading.Thread(target=fetch, args=(self.hedge_api_base,))
+            worker.daemon = True
+            worker.start()
+
+        worker = threading.Thread(target=fetch, args=(self.api_base,))
+        worker.daemon = True
+        worker.start()
+        outstanding = 1
+        hedged = False
+        error = None
+        while outstanding:
+            remaining = timeout - (time.time() - started)
+            try:
+                succeeded, answer = answers.get(timeout=max(0, remaining if hedged else min(hedge_after, remaining)))
+            except Queue.Empty:
+                if hedged or remaining <= 0:
+                    break
+                # The first request is slower than usual, so race a duplicate against it.
+                hedge()
+                hedged = True
+                outstanding += 1
+                continue
+            outstanding -= 1
+            if succeeded:
+                self.latencies.append(time.time() - started)
+                return answer
+            error = answer
+            if not hedged:
+                hedge()
+                hedged = True
+                outstanding += 1
+        if isinstance(error, (IOError, httplib.HTTPException)):
+            raise error
+        raise socket.timeout('timed out waiting for DSTK')
 
     def ip2coordinates(self, ips):
 
         if not isinstance(ips, (list, tuple)):
             ips = [ips]
 
-        api_url = self.api_base+'/ip2coordinates'
         api_body = json.dumps(ips)
-        response_string = urllib.urlopen(api_url, api_body).read()
-
-        response = json.loads(response_string)
+        response = self._request('/ip2coordinates', api_body)
 
         if 'error' in response:
             raise Exception(response['error'])
@@ -95,26 +303,90 @@ class DSTK:
         return response
 
     def street2coordinates(self, addresses):
+        """
+        Geocode addresses, returning a dictionary keyed by each address given. Addresses equal under coalesce_key
+        are only looked up once, both within one call and across threads: a thread asking for an address another
+        thread is already waiting on shares that lookup's result instead of sending its own.
+        """
+        if not isinstance(addresses, (list, tuple)):
+            addresses = [addresses]
+
+        keys = [coalesce_key(address) for address in addresses]
+        own = []
+        flights = {}
+        with self.flights_lock:
+            for address, key in zip(addresses, keys):
+                if key in flights:
+                    continue
+                flight = self.flights.get(key)
+                if flight is None:
+                    flight = self.flights[key] = Flight()
+                    own.append((key, address, flight))
+                flights[key] = flight
+
+        if own:
+            try:
+                api_body = json.dumps([address for key, address, flight in own])
+                response = self._request('/street2coordinates', api_body)
+                if 'error' in response:
+                    raise Exception(response['error'])
+                answers = dict((coalesce_key(address), result) for address, result in response.items())
+                for key, address, flight in own:
+                    flight.result = answers.get(key)
+            except Exception as e:
+                for key, address, flight in own:
+                    flight.error = e
+                raise
+            finally:
+                with self.flights_lock:
+                    for key, address, flight in own:
+                        del self.flights[key]
+                for key, address, flight in own:
+                    flight.done.set()
+
+        response = {}
+        for address, key in zip(addresses, keys):
+            flight = flights[key]
+            if not flight.done.wait(self.deadline + self.timeout):
+                raise DSTKUnavailableError('Timed out waiting for a shared lookup of "'+key+'"')
+            if flight.error is not None:
+                raise flight.error
+            response[address] = flight.result
+        return response
 
+    def street2coordinates_stream(self, addresses):
+        """
+        Like street2coordinates, but returns an iterator of (address, result) pairs decoded as the response
+        arrives, so large batches are never held in memory whole. The request is sent before this returns.
+        Duplicates within the batch are sent once, and their result is yielded once for each address given.
+        """
         if not isinstance(addresses, (list, tuple)):
             addresses = [addresses]
 
-        api_url = self.api_base+'/street2coordinates'
-        api_body = json.dumps(addresses)
-        response_string = urllib.urlopen(api_url, api_body).read()
-        response = json.loads(response_string)
+        # coalesce_key -> every address given with that key
+        duplicates = {}
+        unique = []
+        for address in addresses:
+            key = coalesce_key(address)
+            if key not in duplicates:
+                duplicates[key] = []
+                unique.append(address)
+            duplicates[key].append(address)
 
-        if 'error' in response:
-            raise Exception(response['error'])
+        api_body = json.dumps(unique)
+        response = self._request('/street2coordinates', api_body, stream=True)
 
-        return response
+        return self._fan_out(iter_json_object(response), duplicates)
+
+    def _fan_out(self, pairs, duplicates):
+        for address, result in pairs:
+            for original in duplicates.get(coalesce_key(address), [address]):
+                yield original, result
 
     def coordinates2politics(self, coordinates):
 
-        api_url = self.api_base+'/coordinates2politics'
         api_body = json.dumps(coordinates)
-        response_string = urllib.urlopen(api_url, api_body).read()
-        response = json.loads(response_string)
+        response = self._request('/coordinates2politics', api_body)
 
         if 'error' in response:
             raise Exception(response['error'])
@@ -123,20 +395,25 @@ class DSTK:
 
     def text2places(self, text):
 
-        api_url = self.api_base+'/text2places'
         api_body = text
-        response_string = urllib.urlopen(api_url, api_body).read()
-        response = json.loads(response_string)
+        response = self._request('/text2places', api_body)
 
         if 'error' in response:
             raise Exception(response['error'])
 
         return response
 
-    def file2text(self, file_name, file_data):
+    def file2text(self, file_name, file_data=None):
+        """
+        file_data can be bytes or a binary file object. Without it the file is opened and streamed from disk.
+        """
 
         host = self.api_base.replace('http://', '')
 
+        if file_data is None:
+            with open(file_name, 'rb') as file_data:
+                return post_multipart(host, '/file2text', [], [('inputfile', file_name, file_data)])
+
         response = post_multipart(host,
                                   '/file2text',[],[('inputfile', file_name, file_data)])
 
@@ -144,10 +421,8 @@ class DSTK:
 
     def text2sentences(self, text):
 
-        api_url = self.api_base+'/text2sentences'
         api_body = text
-        response_string = urllib.urlopen(api_url, api_body).read()
-        response = json.loads(response_string)
+        response = self._request('/text2sentences', api_body)
 
         if 'error' in response:
             raise Exception(response['error'])
@@ -156,10 +431,8 @@ class DSTK:
 
     def html2text(self, html):
 
-        api_url = self.api_base+'/html2text'
         api_body = html
-        response_string = urllib.urlopen(api_url, api_body).read()
-        response = json.loads(response_string)
+        response = self._request('/html2text', api_body)
 
         if 'error' in response:
             raise Exception(response['error'])
@@ -168,10 +441,8 @@ class DSTK:
 
     def html2story(self, html):
 
-        api_url = self.api_base+'/html2story'
         api_body = html
-        response_string = urllib.urlopen(api_url, api_body).read()
-        response = json.loads(response_string)
+        response = self._request('/html2story', api_body)
 
         if 'error' in response:
             raise Exception(response['error'])
@@ -180,10 +451,8 @@ class DSTK:
 
     def text2people(self, text):
 
-        api_url = self.api_base+'/text2people'
         api_body = text
-        response_string = urllib.urlopen(api_url, api_body).read()
-        response = json.loads(response_string)
+        response = self._request('/text2people', api_body)
 
         if 'error' in response:
             raise Exception(response['error'])
@@ -192,16 +461,83 @@ class DSTK:
 
     def text2times(self, text):
 
-        api_url = self.api_base+'/text2times'
         api_body = text
-        response_string = urllib.urlopen(api_url, api_body).read()
-        response = json.loads(response_string)
+        response = self._request('/text2times', api_body)
 
         if 'error' in response:
             raise Exception(response['error'])
 
         return response
 
+def iter_json_object(response, chunk_size=64 * 1024):
+    """
+    Incrementally decode a top level JSON object from a file-like response, yielding (key, value) pairs as soon as
+    each value is complete. Only the undecoded tail of the response is buffered. An "error" key raises, as for the
+    non-streaming calls.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    buffer = u''
+    position = 0
+    finished = False
+
+    def fill():
+        # Returns False once the response is exhausted
+        chunk = response.read(chunk_size)
+        if not chunk:
+            return False
+        if isinstance(chunk, bytes):
+            chunk = text_decoder.decode(chunk)
+        return chunk
+
+    def skip_whitespace(text, index):
+        while index < len(text) and text[index] in u' \t\r\n':
+            index += 1
+        return index
+
+    expected = u'{'
+    key = None
+    while True:
+        position = skip_whitespace(buffer, position)
+        if position < len(buffer) and expected is not None:
+            if buffer[position] not in expected:
+                raise ValueError('Unexpected "{0}" in JSON response at {1}'.format(buffer[position], position))
+            if buffer[position] == u'}':
+                return
+            position += 1
+            expected = None
+            continue
+        if position < len(buffer):
+            if key is None and buffer[position] == u'}':
+                return
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                value, end = None, None
+            # A value running to the end of the buffer may be cut short, e.g. a number, so wait for more.
+            if end is not None and (end < len(buffer) or finished):
+                if key is None:
+                    key = value
+                    expected = u':'
+                else:
+                    if key == 'error':
+                        raise Exception(value)
+                    yield key, value
+                    key = None
+                    expected = u',}'
+                position = end
+                continue
+        if finished:
+            raise ValueError('Truncated JSON response')
+        chunk = fill()
+        if chunk is False:
+            finished = True
+            continue
+        # Drop what has been consumed so the buffer only holds the value being decoded.
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
 # We need to post files as multipart form data, and Python has no native function for
 # that, so these utility functions implement what we need.
 # See http://code.activestate.com/recipes/146306/
@@ -209,44 +545,95 @@ def post_multipart(host, selector, fields, files):
     """
     Post fields and files to an http host as multipart/form-data.
     fields is a sequence of (name, value) elements for regular form fields.
-    files is a sequence of (name, filename, value) elements for data to be uploaded as files
+    files is a sequence of (name, filename, value) elements for data to be uploaded as files. value can be bytes or
+    a file object opened in binary mode, which is sent from its current position in chunks rather than read whole.
     Return the server's response page.
     """
-    content_type, body = encode_multipart_formdata(fields, files)
-    h = httplib.HTTP(host)
+    body = MultipartBody(fields, files)
+    h = httplib.HTTPConnection(host)
     h.putrequest('POST', selector)
-    h.putheader('content-type', content_type)
+    h.putheader('content-type', body.content_type)
     h.putheader('content-length', str(len(body)))
     h.endheaders()
-    h.send(body)
-    errcode, errmsg, headers = h.getreply()
-    return h.file.read()
+    for chunk in body.chunks():
+        h.send(chunk)
+    return h.getresponse().read()
+
+class MultipartBody(object):
+    """
+    A multipart/form-data body whose length is known before it is sent. File parts given as file objects are only
+    read while iterating chunks(), chunk_size bytes at a time, so memory use doesn't grow with the file size.
+    """
+
+    BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
+    CRLF = b'\r\n'
+
+    def __init__(self, fields, files, chunk_size=64 * 1024):
+        self.chunk_size = chunk_size
+        self.content_type = 'multipart/form-data; boundary=%s' % self.BOUNDARY
+        # Each part is bytes, or a (file object, size) pair
+        self.parts = []
+        for (key, value) in fields:
+            self._add_text(['--' + self.BOUNDARY, 'Content-Disposition: form-data; name="%s"' % key, '', ''])
+            self.parts.append(value if isinstance(value, bytes) else value.encode('utf-8'))
+            self.parts.append(self.CRLF)
+        for (key, filename, value) in files:
+            self._add_text(['--' + self.BOUNDARY,
+                            'Content-Disposition: form-data; name="%s"; filename="%s"' % (key, filename),
+                            'Content-Type: %s' % guess_content_type(filename), '', ''])
+            if isinstance(value, bytes):
+                self.parts.append(value)
+            elif hasattr(value, 'read'):
+                self.parts.append((value, remaining_size(value)))
+            else:
+                self.parts.append(value.encode('utf-8'))
+            self.parts.append(self.CRLF)
+        self._add_text(['--' + self.BOUNDARY + '--', ''])
+
+    def _add_text(self, lines):
+        self.parts.append(self.CRLF.join(line.encode('utf-8') for line in lines))
+
+    def __len__(self):
+        return sum(part[1] if isinstance(part, tuple) else len(part) for part in self.parts)
+
+    def chunks(self):
+        """
+        Yield the body as bytes chunks.
+        """
+        for part in self.parts:
+            if not isinstance(part, tuple):
+                yield part
+                continue
+            file_object, size = part
+            while size > 0:
+                chunk = file_object.read(min(self.chunk_size, size))
+                if not chunk:
+                    raise IOError('File ended before its expected size while uploading')
+                size -= len(chunk)
+                yield chunk
+
+def remaining_size(file_object):
+    """
+    Number of bytes left to read in a seekable file object.
+    """
+    position = file_object.tell()
+    try:
+        return os.fstat(file_object.fileno()).st_size - position
+    except (AttributeError, IOError, OSError, ValueError):
+        file_object.seek(0, os.SEEK_END)
+        size = file_object.tell() - position
+        file_object.seek(position)
+        return size
 
 def encode_multipart_formdata(fields, files):
     """
     fields is a sequence of (name, value) elements for regular form fields.
     files is a sequence of (name, filename, value) elements for data to be uploaded as files
-    Return (content_type, body) ready for httplib.HTTP instance
+    Return (content_type, body) ready for httplib.HTTPConnection instance. body is bytes. Use MultipartBody to
+    avoid holding large files in memory.
     """
-    BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
-    CRLF = '\r\n'
-    L = []
-    for (key, value) in fields:
-        L.append('--' + BOUNDARY)
-        L.append('Content-Disposition: form-data; name="%s"' % key)
-        L.append('')
-        L.append(value)
-    for (key, filename, value) in files:
-        L.append('--' + BOUNDARY)
-        L.append('Content-Disposition: form-data; name="%s"; filename="%s"' % (key, filename))
-        L.append('Content-Type: %s' % guess_content_type(filename))
-        L.append('')
-        L.append(value)
-    L.append('--' + BOUNDARY + '--')
-    L.append('')
-    body = CRLF.join(L)
-    content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
-    return content_type, body
+    body = MultipartBody(fields, files)
+    return body.content_type, b''.join(body.chunks())
 
 def guess_content_type(filename):
     return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
@@ -254,69 +641,116 @@ def guess_content_type(filename):
 # End of the interface. The rest of this file is an example implementation of a
 # command line client.
 
-def ip2coordinates_cli(dstk, options, inputs, output):
-
-    writer = csv.writer(sys.stdout)
-
-    input_ips = []
-    for input_line in inputs:
-        ip_match = re.match(r'[12]?\d?\d\.[12]?\d?\d\.[12]?\d?\d\.[12]?\d?\d', input_line)
-        if ip_match is not None:
-            input_ips.append(ip_match.group(0))
-        else:
-            print 'No match'
-
-    result = dstk.ip2coordinates(input_ips)
+def batches(inputs, batch_size):
+    """
+    Split an iterable into lists of batch_size items, reading it lazily.
+    """
+    batch = []
+    for item in inputs:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def map_batches(function, inputs, batch_size=100, parallel=1):
+    """
+    Call function on each batch of inputs and yield the results in input order, each as soon as it and the batches
+    before it are done. At most parallel batches are in flight at once, so memory stays bounded by the batch size
+    and parallelism, not the size of the input. Anything a batch raises, SystemExit included, is raised again
+    here in the calling thread.
+    """
+    if parallel <= 1:
+        for batch in batches(inputs, batch_size):
+            yield function(batch)
+        return
 
+    def run(batch, outcome):
+        try:
+            outcome.append((True, function(batch)))
+        except BaseException as e:
+            outcome.append((False, e))
+
+    def finish(worker, outcome):
+        worker.join()
+        if not outcome:
+            raise RuntimeError("A batch worker exited without a result")
+        succeeded, result = outcome[0]
+        if not succeeded:
+            raise result
+        return result
+
+    pending = deque()
+    for batch in batches(inputs, batch_size):
+        outcome = []
+        worker = threading.Thread(target=run, args=(batch, outcome))
+        worker.daemon = True
+        worker.start()
+        pending.append((worker, outcome))
+        if len(pending) >= parallel:
+            yield finish(*pending.popleft())
+    while pending:
+        yield finish(*pending.popleft())
+
+def coordinates_rows_cli(result, key_name, options, writer):
+    """
+    Write one CSV row per key of an ip2coordinates or street2coordinates result, and the header row before the
+    first batch with an answer if showHeaders is set.
+    """
     if options['showHeaders']:
-        for ip, info in result.items():
+        for key, info in result.items():
             if info is None:
                 continue
-            row = ['ip_address']
-            for key, value in info.items():
-                row.append(str(key))
+            row = [key_name]
+            for info_key, value in info.items():
+                row.append(str(info_key))
             writer.writerow(row)
+            # Only once, however many batches follow
+            options['showHeaders'] = False
             break
 
-    for ip, info in result.items():
+    for key, info in result.items():
 
         if info is None:
             info = {}
 
-        row = [ip]
-        for key, value in info.items():
+        row = [key]
+        for info_key, value in info.items():
             row.append(str(value))
 
         writer.writerow(row)
 
-    return
-
-def street2coordinates_cli(dstk, options, inputs, output):
+def ip2coordinates_cli(dstk, options, inputs, output):
 
-    writer = csv.writer(sys.stdout)
+    writer = csv.writer(output)
 
-    result = dstk.street2coordinates(inputs)
+    def lookup(batch):
+        input_ips = []
+        for input_line in batch:
+            ip_match = re.match(r'[12]?\d?\d\.[12]?\d?\d\.[12]?\d?\d\.[12]?\d?\d', input_line)
+            if ip_match is not None:
+                input_ips.append(ip_match.group(0))
+            else:
+                print('No match')
+        if not input_ips:
+            return {}
+        return dstk.ip2coordinates(input_ips)
 
-    if options['showHeaders']:
-        for ip, info in result.items():
-            if info is None:
-                continue
-            row = ['address']
-            for key, value in info.items():
-                row.append(str(key))
-            writer.writerow(row)
-            break
+    for result in map_batches(lookup, inputs, options['batchSize'], options['parallel']):
+        coordinates_rows_cli(result, 'ip_address', options, writer)
+        output.flush()
 
-    for ip, info in result.items():
+    return
 
-        if info is None:
-            info = {}
+def street2coordinates_cli(dstk, options, inputs, output):
 
-        row = [ip]
-        for key, value in info.items():
-            row.append(str(value))
+    writer = csv.writer(output)
 
-        writer.writerow(row)
+    inputs = (address for address in inputs if address.strip())
+    for result in map_batches(dstk.street2coordinates, inputs, options['batchSize'], options['parallel']):
+        coordinates_rows_cli(result, 'address', options, writer)
+        output.flush()
 
     return
 
@@ -324,20 +758,32 @@ def coordinates2politics_cli(dstk, options, inputs, output):
 
     writer = csv.writer(output)
 
-    coordinates_list = []
-    for input in inputs:
-        coordinates = input.split(',')
-        if len(coordinates)!=2:
-            output.write('You must enter coordinates as a series of comma-separated pairs, eg 37.76,-122.42')
-            exit(-1)
-        coordinates_list.append([coordinates[0], coordinates[1]])
-
-    result = dstk.coordinates2politics(coordinates_list)
+    def lookup(batch):
+        coordinates_list = []
+        for input in batch:
+            coordinates = input.split(',')
+            if len(coordinates)!=2:
+                # Raised rather than exiting here, since batches may run in worker threads
+                raise ValueError('You must enter coordinates as a series of comma-separated pairs, eg 37.76,-122.42')
+            coordinates_list.append([coordinates[0], coordinates[1]])
+        return dstk.coordinates2politics(coordinates_list)
 
     if options['showHeaders']:
         row = ['latitude', 'longitude', 'name', 'code', 'type', 'friendly_type']
         writer.writerow(row)
 
+    inputs = (input for input in inputs if input.strip())
+    try:
+        for result in map_batches(lookup, inputs, options['batchSize'], options['parallel']):
+            coordinates2politics_rows_cli(result, writer)
+            output.flush()
+    except ValueError as e:
+        output.write(str(e))
+        exit(-1)
+
+    return
+
+def coordinates2politics_rows_cli(result, writer):
     for info in result:
 
         location = info['location']
@@ -353,8 +799,6 @@ def coordinates2politics_cli(dstk, options, inputs, output):
                    ]
             writer.writerow(row)
 
-    return
-
 def file2text_cli(dstk, options, inputs, output):
 
     for file_name in inputs:
@@ -363,14 +807,17 @@ def file2text_cli(dstk, options, inputs, output):
             full_children = []
             for child in children:
                 full_children.append(os.path.join(file_name, child))
-            file2text_cli(dstk, options, full_children)
+            file2text_cli(dstk, options, full_children, output)
         else:
-            file_data = get_file_or_url_contents(file_name)
             if options['showHeaders']:
                 output.write('--File--: '+file_name+"\n")
-            result = dstk.file2text(file_name, file_data)
+            if re.match(r'http://', file_name):
+                result = dstk.file2text(file_name, get_file_or_url_contents(file_name))
+            else:
+                # Streamed from disk rather than read into memory
+                result = dstk.file2text(file_name)
 
-            print result
+            print(result)
     return
 
 def text2places_cli(dstk, options, inputs, output):
@@ -420,7 +867,7 @@ def html2text_cli(dstk, options, inputs, output):
 
     if options['from_stdin']:
         result = dstk.html2text("\n".join(inputs))
-        print result['text']
+        print(result['text'])
         return
 
     for file_name in inputs:
@@ -435,14 +882,14 @@ def html2text_cli(dstk, options, inputs, output):
             if options['showHeaders']:
                 output.write('--File--: '+file_name+"\n")
             result = dstk.html2text(file_data)
-            print result['text']
+            print(result['text'])
     return
 
 def text2sentences_cli(dstk, options, inputs, output):
 
     if options['from_stdin']:
         result = dstk.text2sentences("\n".join(inputs))
-        print result['sentences']
+        print(result['sentences'])
         return
 
     for file_name in inputs:
@@ -457,7 +904,7 @@ def text2sentences_cli(dstk, options, inputs, output):
             if options['showHeaders']:
                 output.write('--File--: '+file_name+"\n")
             result = dstk.text2sentences(file_data)
-            print result['sentences']
+            print(result['sentences'])
 
     return
 
@@ -465,7 +912,7 @@ def html2story_cli(dstk, options, inputs, output):
 
     if options['from_stdin']:
         result = dstk.html2story("\n".join(inputs))
-        print result['story']
+        print(result['story'])
         return
 
     for file_name in inputs:
@@ -480,7 +927,7 @@ def html2story_cli(dstk, options, inputs, output):
             if options['showHeaders']:
                 output.write('--File--: '+file_name+"\n")
             result = dstk.html2story(file_data)
-            print result['story']
+            print(result['story'])
 
     return
 
@@ -573,40 +1020,42 @@ def text2times_format(result, file_name, writer):
 
 def get_file_or_url_contents(file_name):
     if re.match(r'http://', file_name):
-        file_data = urllib.urlopen(file_name).read()
+        file_data = urlopen(file_name).read()
     else:
-        file_data = open(file_name).read()
+        with open(file_name, 'rb') as f:
+            file_data = f.read()
     return file_data
 
 def print_usage(message=''):
 
-    print message
-    print "Usage:"
-    print "python dstk.py <command> [-a/--api_base 'http://yourhost.com'] [-h/--show_headers] <inputs>"
-    print "Where <command> is one of:"
-    print "  ip2coordinates        (lat/lons for IP addresses)"
-    print "  street2coordinates    (lat/lons for postal addresses)"
-    print "  coordinates2politics  (country/state/county/constituency/etc for lat/lon)"
-    print "  text2places           (lat/lons for places mentioned in unstructured text)"
-    print "  file2text             (PDF/Excel/Word to text, and OCR on PNG/Jpeg/Tiff images)"
-    print "  text2sentences        (parts of the text that look like proper sentences)"
-    print "  html2text             (text version of the HTML document)"
-    print "  html2story            (text version of the HTML with no boilerplate)"
-    print "  text2people           (gender for people mentioned in unstructured text)"
-    print "  text2times            (times and dates mentioned in unstructured text)"
-    print "If no inputs are specified, then standard input will be read and used"
-    print "See http://www.datasciencetoolkit.org/developerdocs for more details"
-    print "Examples:"
-    print "python dstk.py ip2coordinates 67.169.73.113"
-    print "python dstk.py street2coordinates \"2543 Graystone Place, Simi Valley, CA 93065\""
-    print "python dstk.py file2text scanned.jpg"
+    print(message)
+    print("Usage:")
+    print("python dstk.py <command> [-a/--api_base 'http://yourhost.com'] [-h/--show_headers] [-b/--batch_size 100]")
+    print("              [-p/--parallel 1] <inputs>")
+    print("Where <command> is one of:")
+    print("  ip2coordinates        (lat/lons for IP addresses)")
+    print("  street2coordinates    (lat/lons for postal addresses)")
+    print("  coordinates2politics  (country/state/county/constituency/etc for lat/lon)")
+    print("  text2places           (lat/lons for places mentioned in unstructured text)")
+    print("  file2text             (PDF/Excel/Word to text, and OCR on PNG/Jpeg/Tiff images)")
+    print("  text2sentences        (parts of the text that look like proper sentences)")
+    print("  html2text             (text version of the HTML document)")
+    print("  html2story            (text version of the HTML with no boilerplate)")
+    print("  text2people           (gender for people mentioned in unstructured text)")
+    print("  text2times            (times and dates mentioned in unstructured text)")
+    print("If no inputs are specified, then standard input will be read and used")
+    print("ip2coordinates, street2coordinates and coordinates2politics read standard input line by line and send it")
+    print("in batches of batch_size lines, with up to parallel batches in flight, writing each batch as it returns")
+    print("See http://www.datasciencetoolkit.org/developerdocs for more details")
+    print("Examples:")
+    print("python dstk.py ip2coordinates 67.169.73.113")
+    print("python dstk.py street2coordinates \"2543 Graystone Place, Simi Valley, CA 93065\"")
+    print("python dstk.py file2text scanned.jpg")
 
     exit(-1)
 
 if __name__ == '__main__':
 
-    import sys
-
     commands = {
         'ip2coordinates': { 'handler': ip2coordinates_cli },
         'street2coordinates': { 'handler': street2coordinates_cli },
@@ -621,11 +1070,13 @@ if __name__ == '__main__':
         }
     switches = {
         'api_base': True,
-        'show_headers': True
+        'show_headers': True,
+        'batch_size': True,
+        'parallel': True,
     }
 
     command = None
-    options = {'showHeaders': False}
+    options = {'showHeaders': False, 'batchSize': 100, 'parallel': 1}
     inputs = []
 
     ignore_next = False
@@ -641,6 +1092,10 @@ if __name__ == '__main__':
                     option = 'api_base'
                 elif letter == 'h':
                     option = 'show_headers'
+                elif letter == 'b':
+                    option = 'batch_size'
+                elif letter == 'p':
+                    option = 'parallel'
             else:
                 option = arg[2:]
 
@@ -654,6 +1109,11 @@ if __name__ == '__main__':
                 ignore_next = True
             elif option == 'show_headers':
                 options['showHeaders'] = True
+            elif option in ('batch_size', 'parallel'):
+                if (index+2) >= len(sys.argv) or not sys.argv[index+2].isdigit() or int(sys.argv[index+2]) < 1:
+                    print_usage('Option "'+arg+'" needs a positive number')
+                options['batchSize' if option == 'batch_size' else 'parallel'] = int(sys.argv[index+2])
+                ignore_next = True
 
         else:
             if command is None:
@@ -668,7 +1128,8 @@ if __name__ == '__main__':
 
     if len(inputs)<1:
         options['from_stdin'] = True
-        inputs = sys.stdin.readlines()
+        # Read lazily, so batched commands start sending before the input ends
+        inputs = (line.rstrip('\r\n') for line in sys.stdin)
     else:
         options['from_stdin'] = False
 
@@ -0,0 +1,120 @@
+# Offline geocoding from a local file of address ranges, used by the "local" AddressParser backend.
+# The file is TIGER style: each row is one side of a street segment with its house number range and endpoints.
+
+import csv
+from bisect import bisect_right
+
+
+class LocalGeocoder(object):
+    """
+    LocalGeocoder answers geocodes for parsed Address objects by interpolating along street segments, entirely
+    in-process. Segments are grouped under a hashed (street, zip) and (street, city) key, and each group is kept
+    sorted by starting house number so a lookup is one dictionary access and one binary search.
+    """
+
+    def __init__(self, parser, filename=None):
+        """
+        parser is the AddressParser whose prefixes and suffixes are used to normalize street names, so that
+        "North Park Street" in the range file matches a parsed "N. Park St.".
+        """
+        self.parser = parser
+        # key -> (sorted low house numbers, running maximum of the high house numbers, segments in the same order)
+        self.ranges = {}
+        if filename:
+            self.load_ranges(filename)
+
+    def load_ranges(self, filename):
+        """
+        Load address ranges from a csv file with the columns street, city, zip, from_number, to_number, from_lat,
+        from_lng, to_lat, to_lng. A header row is skipped. Ranges may run in either direction.
+        """
+        groups = {}
+        for key, indexed in self.ranges.items():
+            groups[key] = list(indexed[2])
+        with open(filename, 'r') as f:
+            for row in csv.reader(f):
+                if len(row) != 9:
+                    continue
+                try:
+                    from_number, to_number = int(row[3]), int(row[4])
+                    from_lat, from_lng, to_lat, to_lng = [float(value) for value in row[5:9]]
+                except ValueError:
+                    # Header row or junk line
+                    continue
+                if from_number > to_number:
+                    from_number, to_number = to_number, from_number
+                    from_lat, from_lng, to_lat, to_lng = to_lat, to_lng, from_lat, from_lng
+                segment = (from_number, to_number, from_lat, from_lng, to_lat, to_lng)
+                street = self.normalize_street(row[0])
+                if row[2].strip():
+                    groups.setdefault((street, row[2].strip()), []).append(segment)
+                if row[1].strip():
+                    groups.setdefault((street, row[1].strip().lower()), []).append(segment)
+        ranges = {}
+        for key, segments in groups.items():
+            segments.sort()
+            highest = []
+            for segment in segments:
+                highest.append(max(segment[1], highest[-1]) if highest else segment[1])
+            ranges[key] = ([segment[0] for segment in segments], highest, segments)
+        self.ranges = ranges
+
+    def normalize_street(self, street):
+        """
+        Lower case a full street name, drop periods and reduce the prefix and suffix to their abbreviations.
+        E.g. "North Park Street" and "N. Park St." both become "n park st".
+        """
+        tokens = street.replace('.', '').lower().split()
+        if not tokens:
+            return ""
+        if len(tokens) > 1 and tokens[0] in self.parser.prefixes:
+            tokens[0] = self.parser.prefixes[tokens[0]].replace('.', '').lower()
+        if len(tokens) > 1 and tokens[-1].upper() in self.parser.suffixes:
+            tokens[-1] = self.parser.suffixes[tokens[-1].upper()].lower()
+        return " ".join(tokens)
+
+    def street_key(self, address):
+        """
+        Build the normalized street name for a parsed Address.
+        """
+        parts = [part for part in (address.street_prefix, address.street, address.street_suffix) if part]
+        return self.normalize_street(" ".join(parts))
+
+    def lookup(self, street, house_number, zip_code=None, city=None):
+        """
+        Return (lat, lng) for a house number on a normalized street, or None if no range covers it. The zip is
+        tried before the city.
+        """
+        for area in (zip_code, city.lower() if city else None):
+            if not area:
+                continue
+            found = self.ranges.get((street, area))
+            if found is None:
+                continue
+            froms, highest, segments = found
+            index = bisect_right(froms, house_number) - 1
+            # Walk back only while some earlier range still reaches the number, usually zero or one step.
+            while index >= 0 and highest[index] >= house_number:
+                from_number, to_number, from_lat, from_lng, to_lat, to_lng = segments[index]
+                if from_number <= house_number <= to_number:
+                    if to_number == from_number:
+                        fraction = 0.0
+                    else:
+                        fraction = float(house_number - from_number) / (to_number - from_number)
+                    return (from_lat + (to_lat - from_lat) * fraction, from_lng + (to_lng - from_lng) * fraction)
+                index -= 1
+        return None
+
+    def geocode(self, address):
+        """
+        Set lat and lng on a parsed Address in place. Returns True if the address was found.
+        """
+        try:
+            house_number = int(address.house_number)
+        except (TypeError, ValueError):
+            return False
+        location = self.lookup(self.street_key(address), house_number, address.zip, address.city)
+        if location is None:
+            return False
+        address.lat, address.lng = location
+        return True
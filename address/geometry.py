@@ -0,0 +1,108 @@
+# Vectorized distance and bounding box filters over the lat and lng of many geocoded Address objects. Needs numpy;
+# see spatial.py for a pure Python index.
+
+import math
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from .spatial import EARTH_RADIUS_KM, KM_PER_DEGREE
+except (ImportError, ValueError):
+    # Run as a script
+    from spatial import EARTH_RADIUS_KM, KM_PER_DEGREE
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("address.geometry needs numpy.")
+
+
+def haversine_array(lats1, lngs1, lats2, lngs2):
+    """
+    Great circle distances in kilometers between points given in degrees, as numpy arrays or scalars. Arguments
+    broadcast, so one point against arrays of many gives an array of distances, and a column of query points
+    against a row of addresses gives a matrix.
+    """
+    _require_numpy()
+    lats1, lngs1, lats2, lngs2 = [numpy.radians(numpy.asarray(values, dtype=float))
+                                  for values in (lats1, lngs1, lats2, lngs2)]
+    a = numpy.sin((lats2 - lats1) / 2) ** 2 + numpy.cos(lats1) * numpy.cos(lats2) * numpy.sin((lngs2 - lngs1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.minimum(1.0, numpy.sqrt(a)))
+
+
+def bbox_mask(lats, lngs, lat, lng, radius_km):
+    """
+    Boolean mask of the points whose coordinates fall in the bounding box of a circle of radius_km around lat, lng.
+    Every point within radius_km is in the box, so it is a cheap prefilter for haversine_array. Longitudes are
+    compared modulo 360, so boxes crossing the antimeridian work, and boxes reaching a pole cover every longitude.
+    Points with NaN coordinates are never in the box.
+    """
+    _require_numpy()
+    lat_span = radius_km / KM_PER_DEGREE
+    nearest_pole = abs(lat) + lat_span
+    mask = numpy.abs(lats - lat) <= lat_span
+    if nearest_pole < 90.0:
+        lng_span = lat_span / math.cos(math.radians(nearest_pole))
+        if lng_span < 180.0:
+            mask &= numpy.abs((lngs - lng + 180.0) % 360.0 - 180.0) <= lng_span
+    return mask
+
+
+class AddressArray(object):
+    """
+    The coordinates of a list of Address objects in two float arrays, for radius queries over many addresses at
+    once. Addresses without lat or lng get NaN and never match. Queries return indexes into addresses.
+    """
+
+    def __init__(self, addresses):
+        _require_numpy()
+        self.addresses = list(addresses)
+        self.lats = numpy.array([numpy.nan if address.lat is None else float(address.lat)
+                                 for address in self.addresses], dtype=float)
+        self.lngs = numpy.array([numpy.nan if address.lng is None else float(address.lng)
+                                 for address in self.addresses], dtype=float)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def distances(self, lat, lng):
+        """
+        Distance in kilometers from the point to every address, NaN where an address has no coordinates.
+        """
+        return haversine_array(lat, lng, self.lats, self.lngs)
+
+    def within(self, lat, lng, radius_km):
+        """
+        Indexes and distances of the addresses within radius_km of the point, nearest first. Only addresses inside
+        the bounding box have their distance computed.
+        """
+        candidates = numpy.nonzero(bbox_mask(self.lats, self.lngs, lat, lng, radius_km))[0]
+        distances = haversine_array(lat, lng, self.lats[candidates], self.lngs[candidates])
+        inside = distances <= radius_km
+        candidates, distances = candidates[inside], distances[inside]
+        order = numpy.argsort(distances, kind='mergesort')
+        return candidates[order], distances[order]
+
+    def within_any(self, points, radius_km):
+        """
+        Boolean mask of the addresses within radius_km of at least one of points, a list of (lat, lng) pairs.
+        Each point costs one vectorized pass over the addresses, and addresses already matched are skipped.
+        """
+        mask = numpy.zeros(len(self.addresses), dtype=bool)
+        for lat, lng in points:
+            candidates = numpy.nonzero(~mask & bbox_mask(self.lats, self.lngs, lat, lng, radius_km))[0]
+            if len(candidates):
+                distances = haversine_array(lat, lng, self.lats[candidates], self.lngs[candidates])
+                mask[candidates[distances <= radius_km]] = True
+        return mask
+
+    def nearest_distances(self, points):
+        """
+        For each of points, a list of (lat, lng) pairs, the distance to the nearest address. Computes the full
+        points by addresses matrix, so keep len(points) * len(self) within memory.
+        """
+        points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+        matrix = haversine_array(points[:, 0:1], points[:, 1:2], self.lats[numpy.newaxis, :],
+                                 self.lngs[numpy.newaxis, :])
+        return numpy.nanmin(matrix, axis=1) if len(self.addresses) else numpy.full(len(points), numpy.inf)
@@ -0,0 +1,177 @@
+# The word lists an AddressParser matches against. A Lexicon is built off to the side and then swapped into a live
+# parser with one reference assignment, so lists can be updated without restarting long running processes.
+
+import os
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+class Lexicon(object):
+    """
+    Lexicon holds the suffixes, cities and streets used by AddressParser. Each Address keeps the Lexicon that was
+    current when it started parsing, so a parse in flight during AddressParser.swap_lexicon() finishes on the old
+    lists and reads never need a lock. Once swapped in, a Lexicon should be treated as read only; build a new one
+    to change it. An unfrozen Lexicon fills its lookup tables and per state city lists on first use; freeze() fills
+    them up front, and from then on nothing writes to it.
+    """
+    frozen = False
+
+    def __init__(self, suffixes=None, cities=None, streets=None, state_cities=None, cities_dir=None):
+        """
+        suffixes maps upper case long suffixes to their USPS abbreviation. cities and streets are lower case. For
+        state_cities and cities_dir, see load_cities and cities_for_state.
+        """
+        self.suffixes = suffixes if suffixes is not None else {}
+        # Lower case list of cities, used as a hint
+        self.cities = cities if cities is not None else []
+        # Lower case list of streets, used as a hint
+        self.streets = streets if streets is not None else []
+        # State code -> set of lower case cities, or None once a state is known to have no list
+        self.state_cities = state_cities if state_cities is not None else {}
+        self.cities_dir = cities_dir
+        # Words for AddressParser.looks_like_address, built on first use
+        self.screen_words = None
+        # Upper case suffix or abbreviation -> the text an Address stores for it, built on first use
+        self.canonical_suffixes = None
+
+    def copy(self, **fields):
+        """
+        A new Lexicon with this one's lists, except for the fields given, e.g. copy(streets=new_streets). A frozen
+        lexicon's lists are shared, since nothing changes them; otherwise they are copied, so loading into the new
+        lexicon leaves this one as it was. Lazily loaded state cities are only kept if cities_dir is unchanged.
+        """
+        if self.frozen:
+            values = {'suffixes': self.suffixes, 'cities': self.cities, 'streets': self.streets}
+        else:
+            values = {'suffixes': dict(self.suffixes), 'cities': list(self.cities), 'streets': list(self.streets)}
+        values['cities_dir'] = self.cities_dir
+        values.update(fields)
+        if 'state_cities' not in values:
+            keep = 'cities' not in fields and values['cities_dir'] == self.cities_dir
+            values['state_cities'] = {}
+            if keep:
+                for state, cities in self.state_cities.items():
+                    values['state_cities'][state] = set(cities) if isinstance(cities, set) else cities
+        return Lexicon(**values)
+
+    def freeze(self):
+        """
+        Turn cities and streets into frozensets, which also makes each membership check a hash lookup. Every per
+        state list in cities_dir is loaded now, and states without one are left unknown, instead of being filled in
+        while parsing. Returns the lexicon.
+        """
+        if self.cities_dir is not None and not self.frozen:
+            for filename in sorted(os.listdir(self.cities_dir)):
+                state, extension = os.path.splitext(filename)
+                if extension == '.csv':
+                    self.cities_for_state(state)
+        self.cities = frozenset(self.cities)
+        self.state_cities = dict((state, frozenset(cities) if cities is not None else None)
+                                 for state, cities in self.state_cities.items())
+        self.streets = frozenset(self.streets)
+        self.build_canonical_suffixes()
+        self.frozen = True
+        return self
+
+    def build_canonical_suffixes(self):
+        """
+        Map every upper case long suffix and abbreviation to its canonical text, e.g. "STREET" and "ST" to "St.",
+        with one shared object per abbreviation. Returns the mapping, which is also kept in canonical_suffixes.
+        """
+        shared = {}
+        for abbreviation in self.suffixes.values():
+            if abbreviation not in shared:
+                shared[abbreviation] = _text(abbreviation.capitalize() + '.')
+        canonical = dict(shared)
+        # Long forms win over an abbreviation spelled the same, as in Address.check_street_suffix
+        for suffix, abbreviation in self.suffixes.items():
+            canonical[suffix] = shared[abbreviation]
+        self.canonical_suffixes = canonical
+        return canonical
+
+    def load_suffixes(self, filename):
+        """
+        Build the suffix dictionary. The keys will be possible long versions, and the values will be the
+        accepted abbreviations. Everything should be stored using the value version, and you can search all
+        by using building a set of self.suffixes.keys() and self.suffixes.values().
+        """
+        with open(filename, 'r') as f:
+            for line in f:
+                # Make sure we have key and value
+                if len(line.split(',')) != 2:
+                    continue
+                    # Strip off newlines.
+                self.suffixes[line.strip().split(',')[0]] = line.strip().split(',')[1]
+        self.screen_words = None
+        self.canonical_suffixes = None
+
+    def load_cities(self, filename, state_codes=None):
+        """
+        Load up all cities in lowercase for easier matching. The file should have one city per line, with no extra
+        characters, or "state,city" lines such as "WI,Madison". Cities with a state are only matched in that state.
+        A line is only read as "state,city" when the part before the comma is one of state_codes, or any two letter
+        code if state_codes is None, so names like "Lynchburg, Moore" stay whole cities.
+        This isn't strictly required, but will vastly increase the accuracy.
+        """
+        # A copy of a frozen lexicon starts out with its frozensets
+        if not isinstance(self.cities, list):
+            self.cities = list(self.cities)
+        with open(filename, 'r') as f:
+            for line in f:
+                state, comma, city = line.strip().partition(',')
+                state = state.strip().upper()
+                if comma and len(state) == 2 and (state in state_codes if state_codes is not None else state.isalpha()):
+                    cities = self.state_cities.get(state)
+                    if not isinstance(cities, set):
+                        cities = self.state_cities[state] = set(cities or ())
+                    cities.add(city.strip().lower())
+                else:
+                    self.cities.append(line.strip().lower())
+
+    def load_streets(self, filename):
+        """
+        Load up all streets in lowercase for easier matching. The file should have one street per line, with no extra
+        characters. This isn't strictly required, but will vastly increase the accuracy.
+        """
+        if not isinstance(self.streets, list):
+            self.streets = list(self.streets)
+        with open(filename, 'r') as f:
+            for line in f:
+                self.streets.append(line.strip().lower())
+
+    def cities_for_state(self, state):
+        """
+        The lower case cities of a two letter state, loading them from cities_dir on first use unless the lexicon is
+        frozen. None if there is no list for the state.
+        """
+        if not state or len(state) != 2 or not state.isalpha():
+            return None
+        state = state.upper()
+        if state not in self.state_cities and self.cities_dir is not None and not self.frozen:
+            filename = os.path.join(self.cities_dir, state + ".csv")
+            cities = None
+            if os.path.exists(filename):
+                with open(filename, 'r') as f:
+                    cities = frozenset(line.strip().lower() for line in f if line.strip())
+            # Built fully before it is stored, so threads sharing the lexicon never see a partial list.
+            self.state_cities[state] = cities
+        return self.state_cities.get(state)
+
+    def is_city(self, city, state=None):
+        """
+        Whether city, in lower case, is a known city. If state has its own city list, only that list is checked.
+        Otherwise the flat cities list and every state list loaded so far are.
+        """
+        state_cities = self.cities_for_state(state)
+        if state_cities is not None:
+            return city in state_cities
+        if city in self.cities:
+            return True
+        for cities in list(self.state_cities.values()):
+            if cities and city in cities:
+                return True
+        return False
@@ -0,0 +1,285 @@
+# Local replacement for DSTK.coordinates2politics. Loads state, county, city, etc. boundaries from a GeoJSON file and
+# answers which polygons contain each coordinate without any HTTP calls.
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import math
+import os
+import threading
+from collections import OrderedDict
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class LocalPolitics(object):
+    """
+    LocalPolitics finds the polygons containing each coordinate pair and returns the same response shape as
+    DSTK.coordinates2politics. Polygons are indexed on a grid of cell_size degree cells by bounding box, so each point
+    is only tested against the few polygons whose boxes share its cell. Points that share a cell are tested against a
+    polygon together, vectorized with numpy when it is installed.
+    """
+
+    def __init__(self, filename=None, cell_size=1.0):
+        self.cell_size = cell_size
+        # Each polygon is (politic dict, list of rings, bounding box). Rings are lists of (lng, lat) pairs.
+        self.polygons = []
+        # (cell x, cell y) -> list of polygon indexes
+        self.grid = {}
+        if filename:
+            self.load_geojson(filename)
+
+    def load_geojson(self, filename):
+        """
+        Load Polygon and MultiPolygon features from a GeoJSON FeatureCollection. Each feature's properties should
+        have name, code, type and friendly_type, which are returned as-is, e.g.
+        {"name": "Wisconsin", "code": "wi", "type": "admin4", "friendly_type": "state"}.
+        """
+        with open(filename, 'r') as f:
+            collection = json.load(f)
+        for feature in collection.get('features', []):
+            geometry = feature.get('geometry') or {}
+            properties = feature.get('properties') or {}
+            politic = {
+                'name': properties.get('name'),
+                'code': properties.get('code'),
+                'type': properties.get('type'),
+                'friendly_type': properties.get('friendly_type'),
+            }
+            if geometry.get('type') == 'Polygon':
+                self.add_polygon(politic, geometry['coordinates'])
+            elif geometry.get('type') == 'MultiPolygon':
+                for polygon in geometry['coordinates']:
+                    self.add_polygon(politic, polygon)
+
+    def add_polygon(self, politic, rings):
+        """
+        Add one polygon, given as GeoJSON rings (outer ring first, then holes), and index it on the grid.
+        """
+        rings = [[(float(point[0]), float(point[1])) for point in ring] for ring in rings if len(ring) > 2]
+        if not rings:
+            return
+        lngs = [point[0] for point in rings[0]]
+        lats = [point[1] for point in rings[0]]
+        bbox = (min(lngs), min(lats), max(lngs), max(lats))
+        index = len(self.polygons)
+        if numpy is not None:
+            rings = [(numpy.array([point[0] for point in ring]), numpy.array([point[1] for point in ring]))
+                     for ring in rings]
+        self.polygons.append((politic, rings, bbox))
+        low_x, low_y = self._cell(bbox[0], bbox[1])
+        high_x, high_y = self._cell(bbox[2], bbox[3])
+        for x in range(low_x, high_x + 1):
+            for y in range(low_y, high_y + 1):
+                self.grid.setdefault((x, y), []).append(index)
+
+    def _cell(self, lng, lat):
+        return (int(math.floor(lng / self.cell_size)), int(math.floor(lat / self.cell_size)))
+
+    def coordinates2politics(self, coordinates):
+        """
+        coordinates is a list of [latitude, longitude] pairs, as for DSTK. Returns a list in the same order of
+        {'location': {'latitude': ..., 'longitude': ...}, 'politics': [...]}.
+        """
+        if len(coordinates) == 2 and not isinstance(coordinates[0], (list, tuple)):
+            coordinates = [coordinates]
+        lats = [float(pair[0]) for pair in coordinates]
+        lngs = [float(pair[1]) for pair in coordinates]
+        politics = [[] for _ in coordinates]
+        # Group points by grid cell so each candidate polygon gets all of a cell's points in one test.
+        cells = {}
+        for position in range(len(coordinates)):
+            cells.setdefault(self._cell(lngs[position], lats[position]), []).append(position)
+        for cell, positions in cells.items():
+            for index in self.grid.get(cell, []):
+                politic, rings, bbox = self.polygons[index]
+                candidates = [position for position in positions
+                              if bbox[0] <= lngs[position] <= bbox[2] and bbox[1] <= lats[position] <= bbox[3]]
+                if not candidates:
+                    continue
+                inside = self._contains(rings, [lngs[p] for p in candidates], [lats[p] for p in candidates])
+                for position, hit in zip(candidates, inside):
+                    if hit:
+                        politics[position].append(dict(politic))
+        results = []
+        for position in range(len(coordinates)):
+            results.append({
+                'location': {'latitude': lats[position], 'longitude': lngs[position]},
+                'politics': politics[position],
+            })
+        return results
+
+    def address_politics(self, addresses):
+        """
+        Run coordinates2politics on the lat and lng already set on Address objects, e.g. by Address.dstk_parse.
+        Returns a list aligned with addresses, with None for addresses that have no coordinates.
+        """
+        located = [address for address in addresses if address.lat is not None and address.lng is not None]
+        answers = iter(self.coordinates2politics([[address.lat, address.lng] for address in located]))
+        results = []
+        for address in addresses:
+            if address.lat is None or address.lng is None:
+                results.append(None)
+            else:
+                results.append(next(answers))
+        return results
+
+    def _contains(self, rings, xs, ys):
+        """
+        Even-odd ray casting over every ring of a polygon, so holes are handled without special cases.
+        """
+        if numpy is not None:
+            xs = numpy.asarray(xs)
+            ys = numpy.asarray(ys)
+            inside = numpy.zeros(len(xs), dtype=bool)
+            for ring_x, ring_y in rings:
+                previous_x, previous_y = ring_x[-1], ring_y[-1]
+                for x, y in zip(ring_x, ring_y):
+                    if y != previous_y:
+                        crosses = (y > ys) != (previous_y > ys)
+                        crosses &= xs < (previous_x - x) * (ys - y) / (previous_y - y) + x
+                        inside ^= crosses
+                    previous_x, previous_y = x, y
+            return inside.tolist()
+        inside = [False] * len(xs)
+        for ring in rings:
+            previous_x, previous_y = ring[-1]
+            for x, y in ring:
+                if y != previous_y:
+                    for position in range(len(xs)):
+                        point_y = ys[position]
+                        if (y > point_y) != (previous_y > point_y) and \
+                                xs[position] < (previous_x - x) * (point_y - y) / (previous_y - y) + x:
+                            inside[position] = not inside[position]
+                previous_x, previous_y = x, y
+        return inside
+
+
+# Returned by CachedPolitics._get for cells not in the cache
+_missing = object()
+
+
+class CachedPolitics(object):
+    """
+    An LRU cache in front of anything with a coordinates2politics method, such as DSTK or LocalPolitics.
+    Coordinates are snapped to a grid of grid_size degree cells, 0.0001 by default (about 11 meters), so points a
+    few meters apart, like units in one complex, share one lookup. A point within grid_size of a boundary may get
+    the answer of its neighbour across it; use a smaller grid_size where that matters.
+
+    Only cells missing from the cache are sent to source, once each per call, and the answers are merged back in
+    input order with each result's location set to the coordinates asked for. With a filename the cache is loaded
+    from it if it exists and written back by save().
+    """
+
+    def __init__(self, source, grid_size=0.0001, max_size=100000, filename=None):
+        if grid_size <= 0:
+            raise ValueError("grid_size must be positive.")
+        self.source = source
+        self.grid_size = grid_size
+        self.max_size = max_size
+        self.filename = filename
+        # (cell x, cell y) -> list of politics, least recently used first
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if filename and os.path.exists(filename):
+            self.load(filename)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def key(self, lat, lng):
+        return (int(math.floor(float(lat) / self.grid_size + 0.5)), int(math.floor(float(lng) / self.grid_size + 0.5)))
+
+    def _get(self, key):
+        with self.lock:
+            politics = self.cache.pop(key, _missing)
+            if politics is not _missing:
+                # Reinsert as most recently used
+                self.cache[key] = politics
+            return politics
+
+    def _put(self, key, politics):
+        with self.lock:
+            self.cache.pop(key, None)
+            self.cache[key] = politics
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def coordinates2politics(self, coordinates):
+        """
+        coordinates is a list of [latitude, longitude] pairs, or one pair. Returns a list in the same order, like
+        DSTK.coordinates2politics.
+        """
+        if len(coordinates) == 2 and not isinstance(coordinates[0], (list, tuple)):
+            coordinates = [coordinates]
+        keys = [self.key(pair[0], pair[1]) for pair in coordinates]
+        politics = {}
+        # key -> first position asking for it, for the cells not cached
+        missing = OrderedDict()
+        for position, key in enumerate(keys):
+            if key in politics or key in missing:
+                continue
+            cached = self._get(key)
+            if cached is _missing:
+                missing[key] = position
+            else:
+                politics[key] = cached
+        with self.lock:
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            answers = self.source.coordinates2politics([list(coordinates[position])
+                                                        for position in missing.values()])
+            if len(answers) != len(missing):
+                raise ValueError("Expected {0} answers from coordinates2politics, got {1}.".format(
+                    len(missing), len(answers)))
+            for key, answer in zip(missing, answers):
+                # A cell with no politics may come back as null; cache it as empty so it isn't asked for again
+                politics[key] = answer.get('politics') or []
+                self._put(key, politics[key])
+        results = []
+        for pair, key in zip(coordinates, keys):
+            results.append({
+                'location': {'latitude': float(pair[0]), 'longitude': float(pair[1])},
+                'politics': [dict(politic) for politic in politics[key]],
+            })
+        return results
+
+    def load(self, filename):
+        """
+        Add the cells saved in filename. Files saved with a different grid_size are ignored.
+        """
+        with open(filename, 'r') as f:
+            saved = json.load(f)
+        if saved.get('grid_size') != self.grid_size:
+            return
+        for key, politics in saved.get('cells', []):
+            self._put(tuple(key), politics)
+
+    def save(self, filename=None):
+        """
+        Write the cache to filename, or the filename it was created with, least recently used first.
+        """
+        filename = filename or self.filename
+        if not filename:
+            raise ValueError("No filename to save the cache to.")
+        with self.lock:
+            cells = [[list(key), politics] for key, politics in self.cache.items()]
+        # Write to a temporary file first, so a crash never leaves a truncated cache behind.
+        temporary = filename + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'grid_size': self.grid_size, 'cells': cells}, f)
+        if hasattr(os, 'replace'):
+            os.replace(temporary, filename)
+        elif os.name == 'nt' and os.path.exists(filename):
+            # Python 2 on Windows can't rename over an existing file
+            os.remove(filename)
+            os.rename(temporary, filename)
+        else:
+            # Atomic on POSIX
+            os.rename(temporary, filename)
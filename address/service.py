@@ -0,0 +1,240 @@
+# Local HTTP parse service. One preloaded AddressParser is shared by a set of pre-forked worker processes, so many
+# clients can use a warm parser instead of each loading the lexicons themselves.
+#
+#   python -m address.service --port 8080 --workers 4
+#
+# Endpoints:
+#   GET  /parse?address=...             -> {"address": {...}} or {"error": "..."}
+#   POST /parse   {"address": "..."}    -> same
+#   POST /batch   {"addresses": [...]}  -> {"results": [{"address": {...}} or {"error": "..."}, ...]}
+#   GET  /stats                         -> request, address and error counts, throughput and latency
+
+from __future__ import print_function
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import argparse
+import os
+import signal
+import threading
+import time
+from multiprocessing import Lock, Value
+try:
+    from urlparse import urlparse, parse_qs
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from urllib.parse import urlparse, parse_qs
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+try:
+    from .address import AddressParser, InvalidAddressException, DSTKConfidenceTooLowException, \
+        LocalConfidenceTooLowException
+    from .dstk import DSTKError
+except (ImportError, ValueError):
+    # Run as a script
+    from address import AddressParser, InvalidAddressException, DSTKConfidenceTooLowException, \
+        LocalConfidenceTooLowException
+    from dstk import DSTKError
+
+
+class ServiceCounters(object):
+    """
+    Counters kept in shared memory, so every worker process adds to the same totals. Create them before forking.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = Lock()
+        self.requests = Value('l', 0, lock=False)
+        self.addresses = Value('l', 0, lock=False)
+        self.errors = Value('l', 0, lock=False)
+        # Seconds spent handling requests, summed and worst case
+        self.latency = Value('d', 0.0, lock=False)
+        self.max_latency = Value('d', 0.0, lock=False)
+
+    def record(self, addresses, errors, latency):
+        with self.lock:
+            self.requests.value += 1
+            self.addresses.value += addresses
+            self.errors.value += errors
+            self.latency.value += latency
+            if latency > self.max_latency.value:
+                self.max_latency.value = latency
+
+    def stats(self):
+        with self.lock:
+            requests, addresses, errors = self.requests.value, self.addresses.value, self.errors.value
+            latency, max_latency = self.latency.value, self.max_latency.value
+        uptime = time.time() - self.started
+        return {
+            "requests": requests,
+            "addresses": addresses,
+            "errors": errors,
+            "uptime": uptime,
+            "addresses_per_second": addresses / uptime if uptime > 0 else 0.0,
+            "mean_latency_ms": 1000 * latency / requests if requests else 0.0,
+            "max_latency_ms": 1000 * max_latency,
+        }
+
+
+class ParseService(object):
+    """
+    Serves AddressParser over HTTP. The parser is loaded and frozen once in the parent, then worker processes are
+    forked, sharing the listening socket and, through copy on write, the parser's lexicons. With workers=0 the
+    service runs in a thread of the current process instead, which also works where fork() is unavailable.
+
+    The parser passed in is frozen in place, so it can't be loaded into afterwards; see AddressParser.freeze().
+    """
+
+    def __init__(self, parser=None, host='127.0.0.1', port=8080, workers=4, max_batch=1000, logger=None):
+        """
+        parser is frozen, and a default AddressParser is used if it is None. max_batch caps the number of addresses
+        accepted by one /batch request.
+        """
+        self.parser = (parser or AddressParser()).freeze()
+        self.workers = workers
+        self.max_batch = max_batch
+        self.logger = logger
+        self.counters = ServiceCounters()
+        self.pids = []
+        self.thread = None
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                url = urlparse(handler.path)
+                if url.path == '/stats':
+                    self.respond(handler, 200, self.counters.stats())
+                elif url.path == '/parse':
+                    self.handle(handler, [parse_qs(url.query).get('address', [''])[0]], False)
+                else:
+                    self.respond(handler, 404, {"error": "Unknown endpoint."})
+
+            def do_POST(handler):
+                path = urlparse(handler.path).path
+                if path not in ('/parse', '/batch'):
+                    self.respond(handler, 404, {"error": "Unknown endpoint."})
+                    return
+                length = int(handler.headers.get('content-length') or 0)
+                try:
+                    body = json.loads(handler.rfile.read(length).decode('utf-8'))
+                    addresses = [body['address']] if path == '/parse' else list(body['addresses'])
+                except (ValueError, KeyError, TypeError):
+                    self.respond(handler, 400, {"error": "Expected a JSON object with address or addresses."})
+                    return
+                if path == '/parse' and not isinstance(addresses[0], (type(u""), str)):
+                    self.respond(handler, 400, {"error": "address must be a string."})
+                    return
+                if len(addresses) > self.max_batch:
+                    self.respond(handler, 413, {"error": "Batches are limited to {0} addresses.".format(
+                        self.max_batch)})
+                    return
+                self.handle(handler, addresses, path == '/batch')
+
+            def log_message(handler, format, *args):
+                if self.logger: self.logger.debug(format % args)
+
+        self.server = HTTPServer((host, port), Handler)
+        self.api_base = 'http://%s:%d' % self.server.server_address
+
+    def parse(self, address):
+        """
+        Parse one address into a JSON ready result, {"address": {...}} or {"error": "..."}.
+        """
+        return self._parse(address)[1]
+
+    def _parse(self, address):
+        """
+        (status, result) for one address: 200, 422 if it can't be parsed, or 503 if the dstk or hybrid backend
+        failed.
+        """
+        if not isinstance(address, (type(u""), str)):
+            return 422, {"error": "Addresses must be strings."}
+        try:
+            return 200, {"address": self.parser.parse_address(address).as_dict()}
+        except (InvalidAddressException, DSTKConfidenceTooLowException, LocalConfidenceTooLowException, ValueError,
+                TypeError) as e:
+            return 422, {"error": str(e)}
+        except DSTKError as e:
+            if self.logger: self.logger.debug("DSTK failed for {0}: {1}".format(address, e))
+            return 503, {"error": "DSTK unavailable: {0}".format(e)}
+
+    def handle(self, handler, addresses, batch):
+        start = time.time()
+        outcomes = [self._parse(address) for address in addresses]
+        errors = len([status for status, result in outcomes if status != 200])
+        # Count before responding, so a client's next /stats call includes this request.
+        self.counters.record(len(addresses), errors, time.time() - start)
+        if batch:
+            self.respond(handler, 200, {"results": [result for status, result in outcomes]})
+        else:
+            self.respond(handler, outcomes[0][0], outcomes[0][1])
+
+    def respond(self, handler, status, body):
+        response_string = json.dumps(body).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(response_string)))
+        handler.end_headers()
+        handler.wfile.write(response_string)
+
+    def start(self):
+        """
+        Fork the workers, or start the serving thread when workers is 0, and return without waiting.
+        """
+        if self.workers <= 0:
+            self.thread = threading.Thread(target=self.server.serve_forever)
+            self.thread.daemon = True
+            self.thread.start()
+            return self
+        for _ in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                # Worker: serve on the inherited socket until terminated.
+                try:
+                    self.server.serve_forever()
+                finally:
+                    os._exit(0)
+            self.pids.append(pid)
+        if self.logger: self.logger.debug("Started {0} workers on {1}".format(self.workers, self.api_base))
+        return self
+
+    def serve_forever(self):
+        """
+        Start, then block until the workers exit or the process is interrupted.
+        """
+        self.start()
+        try:
+            if self.thread is not None:
+                while self.thread.is_alive():
+                    self.thread.join(1)
+            for pid in self.pids:
+                os.waitpid(pid, 0)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread = None
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.pids = []
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Serve address parsing over HTTP.")
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8080)
+    arg_parser.add_argument('--workers', type=int, default=4)
+    arg_parser.add_argument('--max-batch', type=int, default=1000)
+    args = arg_parser.parse_args()
+    service = ParseService(host=args.host, port=args.port, workers=args.workers, max_batch=args.max_batch)
+    print("Serving on {0} with {1} workers".format(service.api_base, args.workers))
+    service.serve_forever()
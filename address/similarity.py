@@ -0,0 +1,127 @@
+# Batch similarity scoring between addresses. Each address is normalized and encoded to integer token ids once, so
+# scoring one address against thousands of candidates is a few numpy operations instead of a loop building sets.
+# Needs numpy.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from .address import normalize_token
+except (ImportError, ValueError):
+    # Run as a script
+    from address import normalize_token
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("address.similarity needs numpy.")
+
+
+class TokenVocabulary(object):
+    """
+    Maps normalized tokens to integer ids. Tokens are normalized like Address._normalize, using the parser's
+    suffixes and prefixes, without periods. Each distinct raw token is only normalized once.
+    """
+
+    def __init__(self, parser):
+        _require_numpy()
+        self.parser = parser
+        # normalized token -> id
+        self.ids = {}
+        # raw token -> id
+        self.token_ids = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def token_id(self, token):
+        token_id = self.token_ids.get(token)
+        if token_id is None:
+            # Periods are dropped afterwards, as in cluster.address_tokens, since "W" and "W." normalize differently
+            normalized = normalize_token(token, self.parser.suffixes, self.parser.prefixes).replace('.', '')
+            token_id = self.ids.setdefault(normalized, len(self.ids))
+            self.token_ids[token] = token_id
+        return token_id
+
+    def encode(self, address):
+        """
+        The sorted, unique token ids of an address string or Address object, as a numpy array. Address objects are
+        encoded from full_address(). Commas are ignored.
+        """
+        if not isinstance(address, (type(u""), str, bytes)):
+            address = address.full_address()
+        if isinstance(address, bytes):
+            address = address.decode('utf-8')
+        return numpy.unique(numpy.array([self.token_id(token) for token in address.replace(',', ' ').split()],
+                                        dtype=numpy.int64))
+
+
+class CandidateSet(object):
+    """
+    A fixed list of candidate addresses, encoded once, to score queries against. The token ids of every candidate
+    are kept in one flat array with the index of the candidate each came from, so a query is scored against all
+    of them with one membership test and one bincount.
+    """
+
+    def __init__(self, vocabulary, candidates):
+        self.vocabulary = vocabulary
+        self.candidates = list(candidates)
+        encoded = [vocabulary.encode(candidate) for candidate in self.candidates]
+        self.sizes = numpy.array([len(ids) for ids in encoded], dtype=numpy.int64)
+        self.token_ids = numpy.concatenate(encoded) if encoded else numpy.zeros(0, dtype=numpy.int64)
+        self.owners = numpy.repeat(numpy.arange(len(encoded)), self.sizes)
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def intersections(self, query_ids):
+        """
+        Number of tokens each candidate shares with an encoded query.
+        """
+        # Only query_ids is unique; token_ids repeats ids shared by several candidates
+        hits = numpy.isin(self.token_ids, query_ids)
+        return numpy.bincount(self.owners[hits], minlength=len(self.candidates))
+
+    def uniques(self, query):
+        """
+        Like Address._get_dstk_intersections against every candidate: arrays of the number of tokens only in the
+        query and the number only in each candidate.
+        """
+        query_ids = self.vocabulary.encode(query)
+        shared = self.intersections(query_ids)
+        return len(query_ids) - shared, self.sizes - shared
+
+    def scores(self, query):
+        """
+        Jaccard similarity of the query's tokens with each candidate's, as a float array aligned with candidates.
+        Two empty token sets score 1.
+        """
+        query_ids = self.vocabulary.encode(query)
+        shared = self.intersections(query_ids)
+        union = len(query_ids) + self.sizes - shared
+        scores = numpy.ones(len(self.candidates))
+        numpy.divide(shared, union, out=scores, where=union > 0)
+        return scores
+
+    def best(self, query):
+        """
+        (index, score) of the most similar candidate, or (None, 0.0) if there are no candidates.
+        """
+        if not self.candidates:
+            return None, 0.0
+        scores = self.scores(query)
+        index = int(numpy.argmax(scores))
+        return index, float(scores[index])
+
+
+def similarity_matrix(parser, queries, candidates):
+    """
+    Jaccard similarity of every query against every candidate, as a len(queries) by len(candidates) array.
+    Candidates are encoded once and each query row is scored in one vectorized pass.
+    """
+    candidate_set = CandidateSet(TokenVocabulary(parser), candidates)
+    matrix = numpy.zeros((len(queries), len(candidate_set)))
+    for row, query in enumerate(queries):
+        matrix[row] = candidate_set.scores(query)
+    return matrix
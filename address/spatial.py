@@ -0,0 +1,122 @@
+# In-memory spatial index over geocoded Address objects, for radius and k-nearest queries.
+
+import math
+from array import array
+
+EARTH_RADIUS_KM = 6371.0088
+# Length of one degree of latitude.
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Great circle distance in kilometers between two points given in degrees.
+    """
+    lat1, lng1, lat2, lng2 = math.radians(lat1), math.radians(lng1), math.radians(lat2), math.radians(lng2)
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class AddressIndex(object):
+    """
+    AddressIndex buckets Address objects with lat and lng into a grid of cell_size degree cells. Coordinates live in
+    flat arrays, so a query only touches the cells overlapping its bounding box and compares plain floats. Inserts
+    and removals are O(1) apart from the removal from a cell's bucket; removed slots are reused.
+    """
+
+    def __init__(self, addresses=None, cell_size=0.01):
+        self.cell_size = cell_size
+        self.lats = array('d')
+        self.lngs = array('d')
+        self.addresses = []
+        # (cell x, cell y) -> list of slots
+        self.grid = {}
+        self.free_slots = []
+        if addresses:
+            for address in addresses:
+                if address.lat is not None and address.lng is not None:
+                    self.insert(address)
+
+    def __len__(self):
+        return len(self.addresses) - len(self.free_slots)
+
+    def _cell(self, lat, lng):
+        return (int(math.floor(lng / self.cell_size)), int(math.floor(lat / self.cell_size)))
+
+    def insert(self, address, lat=None, lng=None):
+        """
+        Add an address, using its own lat and lng unless given. Returns the slot id used by remove().
+        """
+        lat = float(address.lat if lat is None else lat)
+        lng = float(address.lng if lng is None else lng)
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.lats[slot] = lat
+            self.lngs[slot] = lng
+            self.addresses[slot] = address
+        else:
+            slot = len(self.addresses)
+            self.lats.append(lat)
+            self.lngs.append(lng)
+            self.addresses.append(address)
+        self.grid.setdefault(self._cell(lat, lng), []).append(slot)
+        return slot
+
+    def remove(self, slot):
+        """
+        Remove the address stored under slot, as returned by insert().
+        """
+        if slot >= len(self.addresses) or self.addresses[slot] is None:
+            raise KeyError(slot)
+        cell = self._cell(self.lats[slot], self.lngs[slot])
+        bucket = self.grid[cell]
+        bucket.remove(slot)
+        if not bucket:
+            del self.grid[cell]
+        self.addresses[slot] = None
+        self.free_slots.append(slot)
+
+    def within(self, lat, lng, radius_km):
+        """
+        Return (distance_km, address) pairs for every address within radius_km of the point, nearest first.
+        """
+        lat_span = radius_km / KM_PER_DEGREE
+        nearest_pole = abs(lat) + lat_span
+        lng_span = lat_span / math.cos(math.radians(nearest_pole)) if nearest_pole < 90.0 else 180.0
+        low_lng, high_lng = lng - lng_span, lng + lng_span
+        if low_lng < -180.0 or high_lng > 180.0:
+            # Over a pole or the antimeridian, search every longitude rather than wrapping the box.
+            low_lng, high_lng = -180.0, 180.0
+        low_x, low_y = self._cell(lat - lat_span, low_lng)
+        high_x, high_y = self._cell(lat + lat_span, high_lng)
+        if (high_x - low_x + 1) * (high_y - low_y + 1) > len(self.grid):
+            # Big radius over a sparse index, so walk the occupied cells instead of the box.
+            cells = [cell for cell in self.grid if low_x <= cell[0] <= high_x and low_y <= cell[1] <= high_y]
+        else:
+            cells = [(x, y) for x in range(low_x, high_x + 1) for y in range(low_y, high_y + 1)]
+        lats, lngs = self.lats, self.lngs
+        found = []
+        for cell in cells:
+            for slot in self.grid.get(cell, ()):
+                if abs(lats[slot] - lat) > lat_span:
+                    continue
+                distance = haversine(lat, lng, lats[slot], lngs[slot])
+                if distance <= radius_km:
+                    found.append((distance, slot))
+        found.sort()
+        return [(distance, self.addresses[slot]) for distance, slot in found]
+
+    def nearest(self, lat, lng, k=1):
+        """
+        Return the k nearest (distance_km, address) pairs, nearest first. Searches with a growing radius; once k
+        addresses are inside the radius, nothing outside it can be nearer.
+        """
+        k = min(k, len(self))
+        if k <= 0:
+            return []
+        radius_km = self.cell_size * KM_PER_DEGREE
+        while True:
+            found = self.within(lat, lng, radius_km)
+            if len(found) >= k or radius_km > math.pi * EARTH_RADIUS_KM:
+                return found[:k]
+            radius_km *= 2
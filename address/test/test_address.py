@@ -1,5 +1,12 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from ..address import Address, AddressParser
+from ..address import Address, AddressParser, InvalidAddressException, LocalConfidenceTooLowException, \
+    AddressTooLongException, ParseTimeoutException
 
 
 class AddressTest(unittest.TestCase):
@@ -112,6 +119,68 @@ class AddressTest(unittest.TestCase):
         self.assertTrue(addr.apartment == None)
         # self.assertTrue(addr.building == None)
 
+    def test_zip_fills_state(self):
+        addr = Address("2 N. Park Street, Madison 53703", self.parser)
+        self.assertTrue(addr.zip == "53703")
+        self.assertTrue(addr.state == "WI")
+
+    def test_zip_state_mismatch(self):
+        self.assertRaises(InvalidAddressException, Address, "2 N. Park Street, Madison, WI 90210", self.parser)
+
+
+class FakeDSTK(object):
+    def __init__(self):
+        self.requests = []
+
+    def street2coordinates(self, addresses):
+        if not isinstance(addresses, (list, tuple)):
+            addresses = [addresses]
+        self.requests.append(list(addresses))
+        result = {}
+        for address in addresses:
+            result[address] = {
+                "confidence": 0.9, "street_address": "123 West Mifflin St", "street_number": "123",
+                "street_name": "West Mifflin St", "locality": "Madison", "region": "WI",
+                "latitude": 43.07, "longitude": -89.39,
+            }
+        return result
+
+    def street2coordinates_stream(self, addresses):
+        return iter(self.street2coordinates(addresses).items())
+
+
+class HybridTest(unittest.TestCase):
+    parser = None
+
+    def setUp(self):
+        self.parser = AddressParser()
+        self.parser.backend = "hybrid"
+        self.parser.dstk = FakeDSTK()
+
+    def test_local_confidence(self):
+        self.assertTrue(Address("2 N. Park Street, Madison, WI 53703", self.parser).local_confidence() == 1.0)
+        self.assertRaises(LocalConfidenceTooLowException, Address, "230 Lakelawn", self.parser, escalate=False)
+
+    def test_confident_address_stays_local(self):
+        addr = Address("2 N. Park Street, Madison, WI 53703", self.parser)
+        self.assertTrue(addr.street == "Park")
+        self.assertTrue(addr.lat is None)
+        self.assertTrue(self.parser.dstk.requests == [])
+
+    def test_unsure_address_escalates(self):
+        addr = Address("123 West Mifflin St Madison", self.parser)
+        self.assertTrue(addr.street == "Mifflin")
+        self.assertTrue(addr.city == "Madison")
+        self.assertTrue(addr.lat == 43.07)
+        self.assertTrue(len(self.parser.dstk.requests) == 1)
+
+    def test_multi_address_batches_escalations(self):
+        addresses = self.parser.dstk_multi_address(["2 N. Park Street, Madison, WI 53703",
+                                                    "123 West Mifflin St Madison",
+                                                    "504 W. Washington Ave., Madison, WI 53703"])
+        self.assertTrue(len(addresses) == 3)
+        self.assertTrue(self.parser.dstk.requests == [["123 West Mifflin St Madison"]])
+
 
 class AddressParserTest(unittest.TestCase):
     ap = None
@@ -128,6 +197,219 @@ class AddressParserTest(unittest.TestCase):
     def test_load_states(self):
         self.assertTrue(self.ap.states["Wisconsin"] == "WI")
 
+    def test_load_zip_states(self):
+        self.assertTrue(self.ap.state_for_zip("53703") == "WI")
+        self.assertTrue(self.ap.state_for_zip("73301") == "TX")
+        self.assertTrue(self.ap.state_for_zip("00100") is None)
+
+    def test_text_native(self):
+        ap = AddressParser(text_native=True)
+        first = ap.parse_address("2 N. Park Street, Madison, WI 53703")
+        second = ap.parse_address("504 W. Washington St., Madison, WI 53703")
+        self.assertTrue(isinstance(first.street, type(u"")))
+        self.assertTrue(isinstance(first.original, type(u"")))
+        self.assertTrue(first.street_suffix == u"St.")
+        self.assertTrue(first.street_suffix is second.street_suffix)
+        self.assertTrue(first.state is second.state)
+        # Long and short forms share one object too
+        third = ap.parse_address("10 North Park St, Madison, Wisconsin 53703")
+        self.assertTrue(third.street_suffix is first.street_suffix)
+        self.assertTrue(third.street_prefix is first.street_prefix)
+        self.assertTrue(isinstance(str(first), str))
+
+    @unittest.skipIf(sys.version_info[0] < 3, "byte string fields are only supported on Python 2")
+    def test_text_native_required(self):
+        self.assertRaises(ValueError, AddressParser, text_native=False)
+
+    def test_record_spans(self):
+        ap = AddressParser(record_spans=True)
+        addr = ap.parse_address("123 West Mifflin Street Apt 10, Madison, WI 53703")
+        self.assertTrue(addr.spans["house_number"] == (0, 3))
+        self.assertTrue(addr.span_text("street_prefix") == "West")
+        self.assertTrue(addr.span_text("street") == "Mifflin")
+        self.assertTrue(addr.span_text("street_suffix") == "Street")
+        self.assertTrue(addr.span_text("apartment") == "Apt 10")
+        self.assertTrue(addr.span_text("city") == "Madison")
+        self.assertTrue(addr.span_text("state") == "WI")
+        self.assertTrue(addr.span_text("zip") == "53703")
+        addr = ap.parse_address("2 N. Park Street, Madison 53703")
+        self.assertTrue(addr.span_text("street_prefix") == "N")
+        # Filled in from the zip, not found in the input
+        self.assertTrue(addr.state == "WI")
+        self.assertTrue(addr.span_text("state") is None)
+        self.assertTrue(self.ap.parse_address("2 N. Park Street").spans is None)
+        # Offsets are characters of the input, whatever the field types
+        addr = ap.parse_address(u"123 Caf\xe9 St., Madison, WI 53703")
+        self.assertTrue(addr.spans["street"] == (4, 8))
+        self.assertTrue(addr.span_text("street") == u"Caf\xe9")
+        self.assertTrue(addr.span_text("city") == u"Madison")
+
+    def test_freeze(self):
+        ap = AddressParser().freeze()
+        self.assertTrue("wisconsin rapids" in ap.cities)
+        self.assertRaises(ValueError, ap.load_cities, "cities.csv")
+        # Parsers no longer share the class level lists
+        self.assertTrue(len(AddressParser().cities) == len(self.ap.cities))
+
+    def test_shared_between_threads(self):
+        ap = AddressParser().freeze()
+        addresses = ["2 N. Park Street, Madison, WI 53703", "504 W. Washington Ave., Madison, WI 53703",
+                     "123 West Mifflin Street Apt 10, Madison, WI 53703", "230 Lakelawn"] * 25
+        expected = [str(ap.parse_address(address)) for address in addresses]
+        results = {}
+
+        def parse(thread_number):
+            results[thread_number] = [str(ap.parse_address(address)) for address in addresses]
+
+        threads = [threading.Thread(target=parse, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(results[n] == expected for n in range(8)))
+
+    def test_input_limits(self):
+        self.assertRaises(AddressTooLongException, self.ap.parse_address, "2 N. Park Street " + "x" * 1000)
+        self.assertRaises(AddressTooLongException, self.ap.parse_address, "2 N. Park Street" + " x" * 100)
+        ap = AddressParser(max_length=None, max_tokens=None)
+        # A failed "units" match is not retried from every character of a long word.
+        start = time.time()
+        self.assertRaises(InvalidAddressException, ap.parse_address, "a" * 50000)
+        self.assertTrue(time.time() - start < 1)
+        # Apartment patterns only start at a token boundary
+        self.assertTrue(ap.parse_address("12 Storm 5 Street").apartment is None)
+
+    def test_time_budget(self):
+        ap = AddressParser(time_budget=-1)
+        self.assertRaises(ParseTimeoutException, ap.parse_address, "2 N. Park Street, Madison, WI 53703")
+        self.assertTrue(AddressParser(time_budget=10).parse_address("2 N. Park Street").street == "Park")
+
+    def test_looks_like_address(self):
+        self.assertTrue(self.ap.looks_like_address("2 N. Park Street, Madison, WI 53703"))
+        self.assertTrue(self.ap.looks_like_address("504 Main, Madison WI"))
+        self.assertTrue(self.ap.looks_like_address("12 Oak Ave"))
+        self.assertTrue(not self.ap.looks_like_address("Call for pricing"))
+        self.assertTrue(not self.ap.looks_like_address("Studio available now"))
+        self.assertTrue(not self.ap.looks_like_address("2 bedrooms in town"))
+        self.assertTrue(not self.ap.looks_like_address("2 bedrooms of space"))
+        self.assertTrue(not self.ap.looks_like_address("Call 608-555-1212 for new pricing"))
+        self.assertTrue(self.ap.looks_like_address("10 Broadway, New York"))
+        self.assertTrue(not self.ap.looks_like_address(""))
+
+    def test_parse_addresses(self):
+        addresses = ["2 N. Park Street, Madison, WI 53703", "Call for pricing", "230 Lakelawn", "12 Oak Ave"]
+        stats = {}
+        parsed = self.ap.parse_addresses(addresses, stats=stats)
+        self.assertTrue(parsed[0].street == "Park" and parsed[2].street == "Lakelawn")
+        self.assertTrue(parsed[1] is None)
+        self.assertTrue(stats == {'parsed': 3, 'invalid': 1, 'skipped': 0})
+        parsed = self.ap.parse_addresses(addresses, prescreen=True, stats=stats)
+        self.assertTrue(parsed[0].street == "Park" and parsed[3].street == "Oak")
+        self.assertTrue(parsed[1] is None and parsed[2] is None)
+        self.assertTrue(stats == {'parsed': 5, 'invalid': 1, 'skipped': 2})
+
+    def test_state_cities(self):
+        cities_dir = tempfile.mkdtemp()
+        try:
+            for state, cities in (("WI", ["Madison", "Wisconsin Rapids"]), ("IL", ["Chicago"])):
+                with open(os.path.join(cities_dir, state + ".csv"), 'w') as f:
+                    f.write("\n".join(cities) + "\n")
+            ap = AddressParser(cities_dir=cities_dir)
+            self.assertTrue(len(ap.cities) == 0)
+            self.assertTrue(ap.parse_address("2 N. Park Street, Madison, WI 53703").city == "Madison")
+            self.assertTrue(ap.parse_address("2 N. Park Street, Chicago, WI 53703").city != "Chicago")
+            # The state can come from the zip
+            self.assertTrue(ap.parse_address("2 N. Park Street, Chicago 53703").city != "Chicago")
+            # Only Wisconsin has been loaded
+            self.assertTrue(list(ap.state_cities.keys()) == ["WI"])
+            self.assertTrue(ap.is_city("chicago", "IL"))
+            self.assertTrue(not ap.is_city("madison", "IL"))
+            # No list for Texas, so every loaded state is checked
+            self.assertTrue(ap.is_city("madison", "TX"))
+            self.assertTrue(ap.state_cities["TX"] is None)
+            # A frozen parser loads every state up front and never adds to them while parsing
+            ap = AddressParser(cities_dir=cities_dir).freeze()
+            self.assertTrue(sorted(ap.state_cities.keys()) == ["IL", "WI"])
+            self.assertTrue(ap.parse_address("2 N. Park Street, Madison, TX 77001").city == "Madison")
+            self.assertTrue(sorted(ap.state_cities.keys()) == ["IL", "WI"])
+        finally:
+            shutil.rmtree(cities_dir)
+
+    def test_load_state_tagged_cities(self):
+        handle, filename = tempfile.mkstemp(suffix=".csv")
+        os.close(handle)
+        try:
+            with open(filename, 'w') as f:
+                f.write("WI,Madison\nIL,Chicago\n")
+            ap = AddressParser(cities=["springfield"])
+            ap.load_cities(filename)
+            self.assertTrue(ap.is_city("madison", "WI"))
+            self.assertTrue(not ap.is_city("madison", "IL"))
+            self.assertTrue(ap.is_city("madison") and ap.is_city("springfield"))
+        finally:
+            os.remove(filename)
+
+    def test_dstk_options(self):
+        ap = AddressParser(backend="dstk", dstk_api_base="http://a.example.com",
+                           dstk_options={'apiBase': "http://b.example.com", 'checkVersion': False})
+        self.assertTrue(ap.dstk.api_base == "http://b.example.com")
+
+    def test_load_bundled_cities(self):
+        # "lynchburg, moore" and "islamorada, village of islands" are city names, not state tagged lines
+        self.assertTrue(list(self.ap.state_cities.keys()) == [])
+        self.assertTrue(self.ap.is_city("lynchburg, moore"))
+        self.assertTrue(not self.ap.is_city("village of islands"))
+
+    def test_reload_lexicon(self):
+        handle, filename = tempfile.mkstemp(suffix=".csv")
+        os.close(handle)
+        try:
+            with open(filename, 'w') as f:
+                f.write("lakelawn\n")
+            ap = AddressParser().freeze()
+            before = ap.parse_address("230 Lakelawn, Madison, WI")
+            old = ap.reload_lexicon(streets_file=filename)
+            # Only the streets were replaced, and the new lexicon is frozen like the parser
+            self.assertTrue(ap.streets == frozenset(["lakelawn"]))
+            self.assertTrue(ap.cities is old.cities)
+            self.assertTrue(ap.lexicon.screen_words is not None)
+            self.assertTrue(before.lexicon is old)
+            self.assertTrue(ap.parse_address("230 Lakelawn, Madison, WI").lexicon is ap.lexicon)
+            self.assertRaises(ValueError, ap.load_streets, filename)
+        finally:
+            os.remove(filename)
+
+    def test_load_after_swap(self):
+        handle, filename = tempfile.mkstemp(suffix=".csv")
+        os.close(handle)
+        try:
+            with open(filename, 'w') as f:
+                f.write("lakelawn\nWI,Monona\n")
+            ap = AddressParser(cities=["madison"], streets=["park"])
+            old = ap.swap_lexicon(ap.lexicon.copy())
+            ap.load_cities(filename)
+            ap.load_streets(filename)
+            # The swapped out lexicon, and parses still using it, don't see the new entries
+            self.assertTrue(old.cities == ["madison"] and old.streets == ["park"])
+            self.assertTrue(old.state_cities == {})
+            self.assertTrue(ap.is_city("monona", "WI") and "lakelawn" in ap.streets)
+            # Copies of a frozen lexicon can be loaded into too
+            frozen = AddressParser(cities=["madison"]).freeze()
+            lexicon = frozen.lexicon.copy()
+            lexicon.load_cities(filename)
+            self.assertTrue("lakelawn" in lexicon.cities and frozen.cities == frozenset(["madison"]))
+        finally:
+            os.remove(filename)
+
+    def test_swap_lexicon(self):
+        ap = AddressParser()
+        ap.cities = ["springfield"]
+        self.assertTrue(ap.is_city("springfield") and not ap.is_city("madison"))
+        self.assertTrue(ap.suffixes["ALLEY"] == "ALY")
+        old = ap.swap_lexicon(ap.lexicon.copy(cities=["madison"]))
+        self.assertTrue(old.cities == ["springfield"])
+        self.assertTrue(ap.parse_address("2 N. Park Street, Madison, WI 53703").city == "Madison")
+
     # Not using preloaded streets any more.
 #    def test_load_streets(self):
 #        self.assertTrue("mifflin" in self.ap.streets)
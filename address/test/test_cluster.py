@@ -0,0 +1,37 @@
+import unittest
+from ..address import AddressParser
+from ..cluster import AddressClusterer, address_tokens, cluster_addresses
+
+
+class ClusterTest(unittest.TestCase):
+    ap = None
+
+    def setUp(self):
+        self.ap = AddressParser()
+
+    def test_address_tokens(self):
+        first = address_tokens(self.ap.parse_address("123 W Mifflin St Apt 10, Madison, WI 53703"))
+        second = address_tokens(self.ap.parse_address("123 West Mifflin, #10, Madison, WI 53703"))
+        self.assertTrue(first == frozenset(["w", "mifflin", "st", "10"]))
+        self.assertTrue(second == frozenset(["w", "mifflin", "10"]))
+
+    def test_cluster_addresses(self):
+        addresses = [self.ap.parse_address(line) for line in [
+            "123 W Mifflin St Apt 10, Madison, WI 53703",
+            "123 West Mifflin, #10, Madison, WI 53703",
+            "123 W Mifflin St Apt 11, Madison, WI 53703",
+            "125 W Mifflin St Apt 10, Madison, WI 53703",
+            "123 W. Mifflin Street #10, Madison, WI 53703",
+        ]]
+        labels = cluster_addresses(addresses, threshold=0.7)
+        self.assertTrue(labels[0] == labels[1] == labels[4])
+        self.assertTrue(len(set(labels)) == 3)
+
+    def test_bridging_address_merges_clusters(self):
+        clusterer = AddressClusterer(threshold=0.5)
+        for line in ["123 W Mifflin St, Madison, WI 53703", "123 Mifflin Ave, Madison, WI 53703",
+                     "123 W Mifflin Ave, Madison, WI 53703"]:
+            clusterer.add(self.ap.parse_address(line))
+        # The first two only share "mifflin", the third is close enough to both.
+        self.assertTrue(clusterer.labels.tolist() == [0, 1, 0])
+        self.assertTrue(clusterer.clusters() == [0, 0, 0])
@@ -0,0 +1,360 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from io import BytesIO
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+from .. import dstk
+from ..transport import (DecodedResponse, PooledTransport, ReplayTransport, StubServer, TransferStats, Transport,
+                         UrllibTransport, compress)
+from ..address import AddressParser
+
+
+def response(text):
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return BytesIO(text)
+
+
+class FlakyTransport(Transport):
+    """
+    Transport whose first `failures` requests raise IOError.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.fetches = 0
+
+    def open(self, url, body=None, timeout=None):
+        self.fetches += 1
+        if self.fetches <= self.failures:
+            raise IOError("connection refused")
+        return response('{"version": 50}')
+
+
+def flaky_dstk(failures, options=None):
+    transport = FlakyTransport(failures)
+    client = dstk.DSTK(dict(options or {}, checkVersion=False, retryBackoff=0.001, transport=transport))
+    return client, transport
+
+
+class DSTKResilienceTest(unittest.TestCase):
+
+    def test_retries_then_succeeds(self):
+        client, transport = flaky_dstk(2)
+        self.assertTrue(client._request('/info') == {"version": 50})
+        self.assertTrue(transport.fetches == 3)
+
+    def test_gives_up_after_retries(self):
+        client, transport = flaky_dstk(10, {'retries': 1})
+        self.assertRaises(dstk.DSTKUnavailableError, client._request, '/info')
+        self.assertTrue(transport.fetches == 2)
+
+    def test_circuit_breaker_fails_fast(self):
+        client, transport = flaky_dstk(10, {'retries': 0, 'breakerThreshold': 2, 'breakerResetTimeout': 60})
+        self.assertRaises(dstk.DSTKUnavailableError, client._request, '/info')
+        self.assertRaises(dstk.DSTKUnavailableError, client._request, '/info')
+        self.assertTrue(client.breaker.is_open())
+        self.assertRaises(dstk.DSTKUnavailableError, client._request, '/info')
+        self.assertTrue(transport.fetches == 2)
+        # After the reset timeout one trial call goes through and closes the breaker.
+        client.breaker.opened_at -= 60
+        transport.failures = 0
+        self.assertTrue(client._request('/info') == {"version": 50})
+        self.assertFalse(client.breaker.is_open())
+
+    def test_fallback_to_default_parse(self):
+        ap = AddressParser(dstk_fallback=True)
+        ap.backend = "dstk"
+        ap.dstk, transport = flaky_dstk(100, {'retries': 0})
+        addr = ap.parse_address("2 N. Park Street, Madison, WI 53703")
+        self.assertTrue(addr.street == "Park")
+        self.assertTrue(len(ap.dstk_multi_address(["2 N. Park Street, Madison, WI 53703"])) == 1)
+        ap.dstk_fallback = False
+        self.assertRaises(dstk.DSTKUnavailableError, ap.parse_address, "2 N. Park Street, Madison, WI 53703")
+
+    def test_hedged_request(self):
+        class SlowPrimary(Transport):
+            def open(self, url, body=None, timeout=None):
+                if url.startswith('http://slow'):
+                    time.sleep(0.5)
+                    return response('{"from": "slow"}')
+                return response('{"from": "fast"}')
+
+        client = dstk.DSTK({'checkVersion': False, 'apiBase': 'http://slow', 'hedgeApiBase': 'http://fast',
+                            'transport': SlowPrimary()})
+        client.latencies.extend([0.01] * 20)
+        self.assertTrue(client._request('/info') == {"from": "fast"})
+
+
+class ReplayTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix=".json")
+        os.close(handle)
+        os.remove(self.filename)
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def test_record_and_replay(self):
+        class Live(Transport):
+            calls = 0
+
+            def open(self, url, body=None, timeout=None):
+                Live.calls += 1
+                return response(json.dumps({body: {"confidence": 0.9}}))
+
+        recorder = ReplayTransport(self.filename, Live())
+        live = dstk.DSTK({'checkVersion': False, 'apiBase': 'http://live', 'transport': recorder})
+        live.street2coordinates("2 N. Park Street")
+        recorder.save()
+
+        replay = dstk.DSTK({'checkVersion': False, 'apiBase': 'http://elsewhere', 'retries': 0,
+                            'transport': ReplayTransport(self.filename)})
+        self.assertTrue(replay.street2coordinates("2 N. Park Street") == live.street2coordinates("2 N. Park Street"))
+        self.assertTrue(Live.calls == 1)
+        self.assertTrue(replay.transport.stats.saved() == 0)
+        self.assertRaises(dstk.DSTKUnavailableError, replay.street2coordinates, "504 W. Washington Ave.")
+
+    def test_stub_server(self):
+        replay = ReplayTransport(self.filename)
+        replay.responses['/info'] = '{"version": 50}'
+        stub = StubServer(replay).start()
+        try:
+            client = dstk.DSTK({'apiBase': stub.api_base})
+            self.assertTrue(client._request('/info') == {"version": 50})
+        finally:
+            stub.stop()
+
+    def test_pooled_transport(self):
+        replay = ReplayTransport(self.filename)
+        replay.responses['/info'] = '{"version": 50}'
+        stub = StubServer(replay).start()
+        try:
+            transport = PooledTransport(max_idle=4)
+            client = dstk.DSTK({'apiBase': stub.api_base, 'transport': transport})
+            results = []
+
+            def fetch():
+                for _ in range(10):
+                    results.append(client._request('/info'))
+
+            threads = [threading.Thread(target=fetch) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertTrue(results == [{"version": 50}] * 40)
+            # Connections went back to the pool for reuse
+            pool = transport.pools[('http', stub.api_base[len('http://'):])]
+            self.assertTrue(0 < pool.qsize() <= 4)
+            self.assertRaises(IOError, transport.request, stub.api_base + '/missing')
+        finally:
+            stub.stop()
+
+    def test_compression(self):
+        replay = ReplayTransport(self.filename)
+        body = json.dumps(["2 N. Park Street"])
+        answer = json.dumps({"2 N. Park Street": {"confidence": 0.9, "street_address": "2 N Park St"}})
+        replay.responses[replay.key('/street2coordinates', body)] = answer
+        stub = StubServer(replay).start()
+        try:
+            for transport in (UrllibTransport(), PooledTransport()):
+                client = dstk.DSTK({'apiBase': stub.api_base, 'checkVersion': False, 'transport': transport,
+                                    'compressRequests': 'gzip'})
+                self.assertTrue(client.street2coordinates("2 N. Park Street") == json.loads(answer))
+                stats = transport.stats
+                self.assertTrue(stats.request_raw_bytes == len(body))
+                self.assertTrue(stats.response_raw_bytes == len(answer))
+                self.assertTrue(stats.response_bytes > 0)
+                self.assertTrue(stats.saved() == (stats.request_raw_bytes - stats.request_bytes +
+                                                  stats.response_raw_bytes - stats.response_bytes))
+        finally:
+            stub.stop()
+
+    def test_decoded_response(self):
+        data = json.dumps([{"n": n} for n in range(1000)]).encode('utf-8')
+        for encoding in ('gzip', 'deflate', None):
+            compressed = compress(data, encoding) if encoding else data
+            stats = TransferStats()
+            decoded = DecodedResponse(BytesIO(compressed), encoding, stats, chunk_size=100)
+            self.assertTrue(decoded.read(10) + decoded.read() == data)
+            self.assertTrue(stats.response_bytes == len(compressed))
+            self.assertTrue(stats.response_raw_bytes == len(data))
+        # Raw deflate, without the zlib header
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        raw = compressor.compress(data) + compressor.flush()
+        self.assertTrue(DecodedResponse(BytesIO(raw), 'deflate').read() == data)
+
+
+class StreamingDecodeTest(unittest.TestCase):
+
+    def test_iter_json_object(self):
+        expected = {"2 N. Park Street": {"confidence": 0.9, "numbers": [1, 2.5, "}"]}, "nowhere": None,
+                    "count": 12345, "unicode": u"caf\xe9"}
+        body = json.dumps(expected)
+        for chunk_size in (1, 3, 7, 4096):
+            self.assertTrue(dict(dstk.iter_json_object(response(body), chunk_size)) == expected)
+        self.assertTrue(list(dstk.iter_json_object(response(" {} "))) == [])
+        self.assertRaises(ValueError, list, dstk.iter_json_object(response('{"a": 1')))
+        self.assertRaises(Exception, list, dstk.iter_json_object(response('{"error": "bad input"}')))
+
+    def test_street2coordinates_stream(self):
+        class Echo(Transport):
+            def open(self, url, body=None, timeout=None):
+                return response(json.dumps(dict((address, {"confidence": 1}) for address in json.loads(body))))
+
+        client = dstk.DSTK({'checkVersion': False, 'transport': Echo()})
+        results = client.street2coordinates_stream(["a", "b"])
+        self.assertTrue(next(results) in [(u"a", {"confidence": 1}), (u"b", {"confidence": 1})])
+        self.assertTrue(len(list(results)) == 1)
+
+
+class Geocoder(Transport):
+    """
+    Transport answering street2coordinates requests after a delay, recording each batch it was sent.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.batches = []
+
+    def open(self, url, body=None, timeout=None):
+        time.sleep(self.delay)
+        addresses = json.loads(body)
+        self.batches.append(addresses)
+        return response(json.dumps(dict((address, {"street_address": address}) for address in addresses)))
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_duplicates_in_batch(self):
+        geocoder = Geocoder()
+        client = dstk.DSTK({'checkVersion': False, 'transport': geocoder})
+        addresses = ["2 N. Park Street", "2 N.  Park Street ", "504 W. Washington Ave.", "2 N. Park Street"]
+        results = client.street2coordinates(addresses)
+        self.assertTrue(geocoder.batches == [["2 N. Park Street", "504 W. Washington Ave."]])
+        self.assertTrue(results["2 N.  Park Street "] == {"street_address": "2 N. Park Street"})
+        self.assertTrue(len(results) == 3)
+        pairs = list(client.street2coordinates_stream(addresses))
+        self.assertTrue(geocoder.batches[1] == ["2 N. Park Street", "504 W. Washington Ave."])
+        self.assertTrue(sorted(address for address, result in pairs) == sorted(addresses))
+
+    def test_concurrent_lookups_share_one_request(self):
+        geocoder = Geocoder(delay=0.2)
+        client = dstk.DSTK({'checkVersion': False, 'transport': geocoder})
+        results = []
+
+        def lookup():
+            results.append(client.street2coordinates("2 N. Park Street")["2 N. Park Street"])
+
+        threads = [threading.Thread(target=lookup) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(len(geocoder.batches) == 1)
+        self.assertTrue(results == [{"street_address": "2 N. Park Street"}] * 5)
+        self.assertTrue(client.flights == {})
+
+    def test_failure_reaches_waiters(self):
+        client, transport = flaky_dstk(10, {'retries': 0})
+        self.assertRaises(dstk.DSTKUnavailableError, client.street2coordinates, ["a", "a"])
+        self.assertTrue(client.flights == {})
+
+
+class BatchedCLITest(unittest.TestCase):
+
+    def test_map_batches(self):
+        calls = []
+
+        def double(batch):
+            calls.append(batch)
+            time.sleep(0.01 * (3 - len(calls) % 3))
+            return [item * 2 for item in batch]
+
+        for parallel in (1, 3):
+            del calls[:]
+            results = list(dstk.map_batches(double, iter(range(7)), batch_size=3, parallel=parallel))
+            self.assertTrue(results == [[0, 2, 4], [6, 8, 10], [12]])
+            self.assertTrue(len(calls) == 3)
+
+        def fail(batch):
+            raise IOError("down")
+
+        self.assertRaises(IOError, list, dstk.map_batches(fail, range(4), batch_size=2, parallel=2))
+
+        def leave(batch):
+            raise SystemExit(1)
+
+        self.assertRaises(SystemExit, list, dstk.map_batches(leave, range(4), batch_size=2, parallel=2))
+
+    def test_coordinates2politics_cli_bad_input(self):
+        class Politics(object):
+            def coordinates2politics(self, coordinates):
+                return [{'location': {'latitude': lat, 'longitude': lng}, 'politics': []} for lat, lng in coordinates]
+
+        output = StringIO()
+        options = {'showHeaders': False, 'batchSize': 1, 'parallel': 2}
+        self.assertRaises(SystemExit, dstk.coordinates2politics_cli, Politics(), options, iter(["1,2", "bad", "3,4"]),
+                          output)
+        self.assertTrue("comma-separated pairs" in output.getvalue())
+
+    def test_street2coordinates_cli(self):
+        geocoder = Geocoder()
+        client = dstk.DSTK({'checkVersion': False, 'transport': geocoder})
+        output = StringIO()
+        options = {'showHeaders': True, 'batchSize': 2, 'parallel': 2}
+        addresses = ["2 N. Park Street", "", "504 W. Washington Ave.", "123 W. Mifflin St."]
+        dstk.street2coordinates_cli(client, options, iter(addresses), output)
+        self.assertTrue(sorted(geocoder.batches) == [["123 W. Mifflin St."], ["2 N. Park Street", "504 W. Washington Ave."]])
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0] == "address,street_address")
+        self.assertTrue(len(lines) == 4)
+        self.assertTrue(lines[3] == "123 W. Mifflin St.,123 W. Mifflin St.")
+
+
+class MultipartUploadTest(unittest.TestCase):
+
+    def test_encode_multipart_formdata(self):
+        content_type, body = dstk.encode_multipart_formdata([("a", "1")], [("inputfile", "scan.png", b"\x89PNG")])
+        boundary = dstk.MultipartBody.BOUNDARY.encode('utf-8')
+        self.assertTrue(content_type == 'multipart/form-data; boundary=' + dstk.MultipartBody.BOUNDARY)
+        self.assertTrue(body == b"\r\n".join([
+            b"--" + boundary, b'Content-Disposition: form-data; name="a"', b"", b"1",
+            b"--" + boundary, b'Content-Disposition: form-data; name="inputfile"; filename="scan.png"',
+            b"Content-Type: image/png", b"", b"\x89PNG", b"--" + boundary + b"--", b""]))
+
+    def test_streamed_file2text(self):
+        class Upload(Transport):
+            bodies = []
+
+            def open(self, url, body=None, timeout=None):
+                Upload.bodies.append(body)
+                return response("extracted text")
+
+        handle, filename = tempfile.mkstemp(suffix=".pdf")
+        os.close(handle)
+        stub = StubServer(Upload()).start()
+        try:
+            data = os.urandom(200 * 1024)
+            with open(filename, 'wb') as f:
+                f.write(data)
+            with open(filename, 'rb') as f:
+                body = dstk.MultipartBody([], [("inputfile", filename, f)], chunk_size=1000)
+                self.assertTrue(len(body) == len(dstk.encode_multipart_formdata([], [("inputfile", filename, data)])[1]))
+                self.assertTrue(max(len(chunk) for chunk in body.chunks()) <= 1000)
+            client = dstk.DSTK({'checkVersion': False, 'apiBase': stub.api_base})
+            self.assertTrue(client.file2text(filename) == b"extracted text")
+            self.assertTrue(Upload.bodies[0] == dstk.encode_multipart_formdata([], [("inputfile", filename, data)])[1])
+        finally:
+            stub.stop()
+            os.remove(filename)
@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+from ..address import AddressParser
+
+RANGES = """street,city,zip,from_number,to_number,from_lat,from_lng,to_lat,to_lng
+North Park Street,Madison,53703,2,98,43.0700,-89.4000,43.0800,-89.4000
+North Park Street,Madison,53703,198,100,43.0900,-89.4000,43.0810,-89.4000
+West Mifflin Street,Madison,53703,100,200,43.0750,-89.3900,43.0750,-89.3800
+"""
+
+
+class LocalGeocoderTest(unittest.TestCase):
+    parser = None
+
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix=".csv")
+        with os.fdopen(handle, 'w') as f:
+            f.write(RANGES)
+        self.parser = AddressParser(backend="local", geocoder_file=self.filename)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_interpolates_by_zip(self):
+        addr = self.parser.parse_address("50 N. Park Street, Madison, WI 53703")
+        self.assertAlmostEqual(addr.lat, 43.0750)
+        self.assertAlmostEqual(addr.lng, -89.4000)
+
+    def test_reversed_range_by_city(self):
+        addr = self.parser.parse_address("198 North Park St., Madison, WI")
+        self.assertAlmostEqual(addr.lat, 43.0900)
+
+    def test_not_found(self):
+        addr = self.parser.parse_address("500 W. Mifflin St., Madison, WI 53703")
+        self.assertTrue(addr.lat is None)
+        self.assertTrue(addr.lng is None)
+
+    def test_requires_file(self):
+        self.assertRaises(ValueError, AddressParser, backend="local")
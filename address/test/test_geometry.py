@@ -0,0 +1,53 @@
+import unittest
+from .. import geometry
+from ..spatial import haversine
+
+
+class Point(object):
+    def __init__(self, name, lat, lng):
+        self.name = name
+        self.lat = lat
+        self.lng = lng
+
+
+@unittest.skipIf(geometry.numpy is None, "numpy is not installed")
+class AddressArrayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.points = [
+            Point("capitol", 43.0747, -89.3841),
+            Point("campus", 43.0766, -89.4125),
+            Point("airport", 43.1399, -89.3375),
+            Point("chicago", 41.8781, -87.6298),
+            Point("unlocated", None, None),
+            Point("fiji east", -17.0, 179.9),
+            Point("fiji west", -17.0, -179.9),
+        ]
+        self.array = geometry.AddressArray(self.points)
+
+    def test_haversine_array(self):
+        distances = self.array.distances(43.0747, -89.3841)
+        for point, distance in zip(self.points, distances):
+            if point.lat is not None:
+                self.assertAlmostEqual(distance, haversine(43.0747, -89.3841, point.lat, point.lng), places=6)
+        self.assertTrue(distances[4] != distances[4])
+
+    def test_within(self):
+        indexes, distances = self.array.within(43.0747, -89.3841, 10)
+        self.assertTrue([self.points[i].name for i in indexes] == ["capitol", "campus", "airport"])
+        self.assertTrue(list(distances) == sorted(distances))
+        # Across the antimeridian
+        indexes, distances = self.array.within(-17.0, 179.95, 25)
+        self.assertTrue(sorted(self.points[i].name for i in indexes) == ["fiji east", "fiji west"])
+
+    def test_within_any(self):
+        mask = self.array.within_any([(43.1399, -89.3375), (41.8781, -87.6298)], 1)
+        self.assertTrue([point.name for point, hit in zip(self.points, mask) if hit] == ["airport", "chicago"])
+
+    def test_nearest_distances(self):
+        nearest = self.array.nearest_distances([(43.0747, -89.3841), (41.8781, -87.6298)])
+        self.assertTrue(list(nearest) == [0.0, 0.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
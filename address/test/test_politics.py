@@ -0,0 +1,139 @@
+import json
+import os
+import tempfile
+import unittest
+from ..address import AddressParser
+from ..politics import CachedPolitics, LocalPolitics
+
+BOUNDARIES = {
+    "type": "FeatureCollection",
+    "features": [
+        {
+            "type": "Feature",
+            "properties": {"name": "Square", "code": "sq", "type": "admin4", "friendly_type": "state"},
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [
+                    [[-90.0, 42.0], [-88.0, 42.0], [-88.0, 44.0], [-90.0, 44.0], [-90.0, 42.0]],
+                    [[-89.2, 42.8], [-88.8, 42.8], [-88.8, 43.2], [-89.2, 43.2], [-89.2, 42.8]],
+                ],
+            },
+        },
+        {
+            "type": "Feature",
+            "properties": {"name": "Town", "code": "tn", "type": "admin8", "friendly_type": "city"},
+            "geometry": {
+                "type": "MultiPolygon",
+                "coordinates": [[[[-89.5, 43.0], [-89.3, 43.0], [-89.3, 43.2], [-89.5, 43.2], [-89.5, 43.0]]]],
+            },
+        },
+    ],
+}
+
+
+class LocalPoliticsTest(unittest.TestCase):
+    politics = None
+
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(handle, 'w') as f:
+            json.dump(BOUNDARIES, f)
+        self.politics = LocalPolitics(self.filename)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_coordinates2politics(self):
+        result = self.politics.coordinates2politics([[43.1, -89.4], [43.0, -89.0], [45.0, -89.0], ["42.5", "-88.5"]])
+        self.assertTrue(len(result) == 4)
+        self.assertTrue(result[0]['location'] == {'latitude': 43.1, 'longitude': -89.4})
+        self.assertTrue(sorted(p['name'] for p in result[0]['politics']) == ["Square", "Town"])
+        # Inside the hole
+        self.assertTrue(result[1]['politics'] == [])
+        self.assertTrue(result[2]['politics'] == [])
+        self.assertTrue(result[3]['politics'][0]['friendly_type'] == "state")
+
+    def test_address_politics(self):
+        ap = AddressParser()
+        located = ap.parse_address("2 N. Park Street, Madison, WI 53703")
+        located.lat, located.lng = 43.1, -89.4
+        unlocated = ap.parse_address("504 W. Washington Ave.")
+        result = self.politics.address_politics([located, unlocated])
+        self.assertTrue(len(result[0]['politics']) == 2)
+        self.assertTrue(result[1] is None)
+
+
+class CountingSource(object):
+    """
+    Answers coordinates2politics from a LocalPolitics, recording the coordinates of each call.
+    """
+
+    def __init__(self, politics):
+        self.politics = politics
+        self.calls = []
+
+    def coordinates2politics(self, coordinates):
+        self.calls.append(coordinates)
+        return self.politics.coordinates2politics(coordinates)
+
+
+class CachedPoliticsTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(handle, 'w') as f:
+            json.dump(BOUNDARIES, f)
+        self.source = CountingSource(LocalPolitics(self.filename))
+        handle, self.cache_filename = tempfile.mkstemp(suffix=".json")
+        os.close(handle)
+        os.remove(self.cache_filename)
+
+    def tearDown(self):
+        for filename in (self.filename, self.cache_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def test_batch_hits_and_misses(self):
+        cache = CachedPolitics(self.source)
+        cache.coordinates2politics([43.10001, -89.40001])
+        result = cache.coordinates2politics([[43.10003, -89.40002], [45.0, -89.0], [43.1, -89.4], [45.00001, -89.0]])
+        # Only the one new cell went upstream
+        self.assertTrue(self.source.calls[1] == [[45.0, -89.0]])
+        self.assertTrue([len(info['politics']) for info in result] == [2, 0, 2, 0])
+        self.assertTrue(result[0]['location'] == {'latitude': 43.10003, 'longitude': -89.40002})
+        self.assertTrue(cache.hits == 3 and cache.misses == 2)
+        self.assertTrue(result == LocalPolitics(self.filename).coordinates2politics(
+            [[43.10003, -89.40002], [45.0, -89.0], [43.1, -89.4], [45.00001, -89.0]]))
+
+    def test_null_politics(self):
+        class NullSource(CountingSource):
+            def coordinates2politics(self, coordinates):
+                self.calls.append(coordinates)
+                return [{'location': {'latitude': lat, 'longitude': lng}, 'politics': None} for lat, lng in coordinates]
+
+        source = NullSource(None)
+        cache = CachedPolitics(source)
+        self.assertTrue(cache.coordinates2politics([0.0, 0.0])[0]['politics'] == [])
+        self.assertTrue(cache.coordinates2politics([0.0, 0.0])[0]['politics'] == [])
+        self.assertTrue(len(source.calls) == 1)
+
+    def test_lru_eviction(self):
+        cache = CachedPolitics(self.source, max_size=2)
+        cache.coordinates2politics([[43.1, -89.4], [45.0, -89.0]])
+        cache.coordinates2politics([43.1, -89.4])
+        cache.coordinates2politics([42.5, -88.5])
+        self.assertTrue(len(cache) == 2)
+        cache.coordinates2politics([[43.1, -89.4], [45.0, -89.0]])
+        self.assertTrue(self.source.calls[-1] == [[45.0, -89.0]])
+
+    def test_persistence(self):
+        cache = CachedPolitics(self.source, filename=self.cache_filename)
+        cache.coordinates2politics([[43.1, -89.4], [45.0, -89.0]])
+        cache.save()
+        reloaded = CachedPolitics(self.source, filename=self.cache_filename)
+        self.assertTrue(len(reloaded) == 2)
+        result = reloaded.coordinates2politics([43.1, -89.4])
+        self.assertTrue(len(self.source.calls) == 1)
+        self.assertTrue(sorted(p['name'] for p in result[0]['politics']) == ["Square", "Town"])
+        # A cache saved on another grid is not reused
+        self.assertTrue(len(CachedPolitics(self.source, grid_size=0.01, filename=self.cache_filename)) == 0)
@@ -0,0 +1,92 @@
+import json
+import os
+import unittest
+try:
+    from urllib2 import urlopen, HTTPError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+from ..address import AddressParser
+from ..dstk import DSTKUnavailableError
+from ..service import ParseService
+
+
+class DownDSTK(object):
+    def street2coordinates(self, addresses):
+        raise DSTKUnavailableError("circuit open")
+
+
+def fetch(url, body=None):
+    if body is not None:
+        body = json.dumps(body).encode('utf-8')
+    try:
+        response = urlopen(url, body)
+        return response.getcode(), json.loads(response.read().decode('utf-8'))
+    except HTTPError as e:
+        return e.code, json.loads(e.read().decode('utf-8'))
+
+
+class ParseServiceTest(unittest.TestCase):
+    parser = AddressParser()
+
+    def test_endpoints(self):
+        service = ParseService(self.parser, port=0, workers=0).start()
+        try:
+            status, body = fetch(service.api_base + '/parse?address=2+N.+Park+Street%2C+Madison%2C+WI+53703')
+            self.assertTrue(status == 200)
+            self.assertTrue(body["address"]["street"] == "Park")
+            self.assertTrue(body["address"]["zip"] == "53703")
+            status, body = fetch(service.api_base + '/parse', {"address": "Park Street"})
+            self.assertTrue(status == 422 and "error" in body)
+            status, body = fetch(service.api_base + '/batch',
+                                 {"addresses": ["504 W. Washington Ave., Madison, WI", "Park Street"]})
+            self.assertTrue(status == 200)
+            self.assertTrue(body["results"][0]["address"]["house_number"] == "504")
+            self.assertTrue("error" in body["results"][1])
+            status, body = fetch(service.api_base + '/batch', {"address": "2 N. Park Street"})
+            self.assertTrue(status == 400)
+            status, body = fetch(service.api_base + '/parse', {"address": None})
+            self.assertTrue(status == 400 and "error" in body)
+            status, body = fetch(service.api_base + '/batch', {"addresses": [["1 Main St"], None]})
+            self.assertTrue(status == 200)
+            self.assertTrue(all("error" in result for result in body["results"]))
+            status, body = fetch(service.api_base + '/stats')
+            self.assertTrue(body["requests"] == 4)
+            self.assertTrue(body["addresses"] == 6)
+            self.assertTrue(body["errors"] == 4)
+        finally:
+            service.stop()
+
+    def test_backend_unavailable(self):
+        parser = AddressParser()
+        parser.backend = "dstk"
+        parser.dstk = DownDSTK()
+        service = ParseService(parser, port=0, workers=0).start()
+        try:
+            status, body = fetch(service.api_base + '/parse', {"address": "2 N. Park Street"})
+            self.assertTrue(status == 503 and "error" in body)
+            status, body = fetch(service.api_base + '/batch', {"addresses": ["2 N. Park Street"]})
+            self.assertTrue(status == 200 and "error" in body["results"][0])
+            status, body = fetch(service.api_base + '/stats')
+            self.assertTrue(body["requests"] == 2 and body["errors"] == 2)
+        finally:
+            service.stop()
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "pre-forked workers need fork()")
+    def test_forked_workers(self):
+        service = ParseService(self.parser, port=0, workers=2, max_batch=2).start()
+        try:
+            for _ in range(4):
+                status, body = fetch(service.api_base + '/parse', {"address": "2 N. Park Street"})
+                self.assertTrue(body["address"]["street"] == "Park")
+            status, body = fetch(service.api_base + '/batch', {"addresses": ["1 Main St"] * 3})
+            self.assertTrue(status == 413)
+            # Counters are shared between the workers
+            status, body = fetch(service.api_base + '/stats')
+            self.assertTrue(body["requests"] == 4)
+        finally:
+            service.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
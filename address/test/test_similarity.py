@@ -0,0 +1,51 @@
+import unittest
+from .. import similarity
+from ..address import AddressParser
+
+
+@unittest.skipIf(similarity.numpy is None, "numpy is not installed")
+class CandidateSetTest(unittest.TestCase):
+    parser = AddressParser()
+
+    def setUp(self):
+        self.candidates = ["123 W Mifflin St", "123 West Mifflin Street Apt 10", "504 W Washington Ave", ""]
+        self.vocabulary = similarity.TokenVocabulary(self.parser)
+        self.candidate_set = similarity.CandidateSet(self.vocabulary, self.candidates)
+
+    def test_encode(self):
+        self.assertTrue(list(self.vocabulary.encode("123 West Mifflin Street")) ==
+                        list(self.vocabulary.encode("123 W. Mifflin St, ")))
+
+    def test_scores(self):
+        scores = self.candidate_set.scores("123 West Mifflin St.")
+        self.assertTrue(scores[0] == 1.0)
+        self.assertAlmostEqual(scores[1], 4.0 / 6)
+        self.assertAlmostEqual(scores[2], 1.0 / 7)
+        self.assertTrue(scores[3] == 0.0)
+        self.assertTrue(self.candidate_set.best("504 West Washington Avenue") == (2, 1.0))
+
+    def test_long_query(self):
+        # Candidates repeat token ids, and a long, widely spread query makes numpy compare by sorting
+        mifflin = self.vocabulary.token_id("Mifflin")
+        query_ids = similarity.numpy.concatenate([[mifflin], similarity.numpy.arange(1, 1000) * 100000])
+        self.assertTrue(list(self.candidate_set.intersections(query_ids)) == [1, 1, 0, 0])
+
+    def test_uniques(self):
+        query = "123 W Mifflin St Apt 10"
+        only_query, only_candidate = self.candidate_set.uniques(query)
+        address = self.parser.parse_address("1 Main St")
+        for index, candidate in enumerate(self.candidates):
+            self.assertTrue((only_query[index], only_candidate[index]) ==
+                            address._get_dstk_intersections(query, candidate))
+
+    def test_similarity_matrix(self):
+        addresses = [self.parser.parse_address("123 West Mifflin Street, Madison, WI"),
+                     self.parser.parse_address("504 W. Washington Ave.")]
+        matrix = similarity.similarity_matrix(self.parser, addresses, self.candidates[:3])
+        self.assertTrue(matrix.shape == (2, 3))
+        self.assertTrue(matrix[1][2] == 1.0)
+        self.assertTrue(matrix[0][0] > matrix[0][2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+from ..spatial import AddressIndex, haversine
+
+
+class Point(object):
+    def __init__(self, name, lat, lng):
+        self.name = name
+        self.lat = lat
+        self.lng = lng
+
+
+class AddressIndexTest(unittest.TestCase):
+    index = None
+
+    def setUp(self):
+        self.points = [
+            Point("capitol", 43.0747, -89.3841),
+            Point("campus", 43.0766, -89.4125),
+            Point("airport", 43.1399, -89.3375),
+            Point("chicago", 41.8781, -87.6298),
+            Point("tokyo", 35.6762, 139.6503),
+            Point("unlocated", None, None),
+        ]
+        self.index = AddressIndex(self.points)
+
+    def test_haversine(self):
+        self.assertAlmostEqual(haversine(43.0, -89.0, 44.0, -89.0), 111.195, places=2)
+        self.assertTrue(195 < haversine(43.0747, -89.3841, 41.8781, -87.6298) < 197)
+
+    def test_within(self):
+        found = self.index.within(43.0747, -89.3841, 5)
+        self.assertTrue([p.name for d, p in found] == ["capitol", "campus"])
+        self.assertTrue(found[0][0] == 0.0)
+
+    def test_nearest(self):
+        found = self.index.nearest(43.0, -89.4, k=3)
+        self.assertTrue([p.name for d, p in found] == ["capitol", "campus", "airport"])
+        found = self.index.nearest(43.0, -89.4, k=10)
+        self.assertTrue(len(found) == 5)
+        self.assertTrue(found[-1][1].name == "tokyo")
+
+    def test_insert_and_remove(self):
+        self.assertTrue(len(self.index) == 5)
+        slot = self.index.insert(Point("statefair", 43.0167, -89.3628))
+        self.assertTrue(self.index.nearest(43.0167, -89.3628)[0][1].name == "statefair")
+        self.index.remove(slot)
+        self.assertTrue(self.index.nearest(43.0167, -89.3628)[0][1].name == "capitol")
+        self.assertRaises(KeyError, self.index.remove, slot)
+        self.assertTrue(len(self.index) == 5)
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from ..address import AddressParser
+from ..typeahead import PrefixIndex, Typeahead
+
+
+class TypeaheadTest(unittest.TestCase):
+    parser = AddressParser()
+
+    def test_prefix_index(self):
+        index = PrefixIndex(["Madison", "madison", "Mad River", "Maple Bluff", "Middleton", " "])
+        self.assertTrue(len(index) == 4)
+        self.assertTrue(index.complete("ma") == ["mad river", "madison", "maple bluff"])
+        self.assertTrue(index.complete("MAD", k=1) == ["mad river"])
+        self.assertTrue(index.complete("madison") == ["madison"])
+        self.assertTrue(index.complete("x") == [])
+
+    def test_default_cities(self):
+        typeahead = Typeahead(self.parser)
+        self.assertTrue("wisconsin rapids" in typeahead.complete_city("wisconsin r"))
+        start = time.time()
+        for _ in range(1000):
+            typeahead.complete_city("mad", k=5)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_custom_lists_and_states(self):
+        cities_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(cities_dir, "WI.csv"), 'w') as f:
+                f.write("Madison\nMarshall\n")
+            with open(os.path.join(cities_dir, "TX.csv"), 'w') as f:
+                f.write("Marshall\nMarfa\n")
+            parser = AddressParser(cities=["springfield"], streets=["mifflin", "main", "monroe"], cities_dir=cities_dir)
+            typeahead = Typeahead(parser)
+            self.assertTrue(typeahead.complete_street("m", k=2) == ["main", "mifflin"])
+            self.assertTrue(typeahead.complete_city("mar", state="TX") == ["marfa", "marshall"])
+            self.assertTrue(typeahead.complete_city("ma", state="wi") == ["madison", "marshall"])
+            # No list for Illinois, so all cities known up front
+            self.assertTrue(typeahead.complete_city("s", state="IL") == ["springfield"])
+        finally:
+            shutil.rmtree(cities_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,377 @@
+# Transports carry DSTK requests. UrllibTransport talks to a real server; ReplayTransport serves responses captured
+# on disk so the DSTK code path can be benchmarked and regression tested offline, and StubServer puts a replay
+# behind a local HTTP port for tools that need a real URL.
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import os
+import threading
+import zlib
+from io import BytesIO
+try:
+    from urllib2 import urlopen, Request
+    from urlparse import urlparse
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    import httplib
+    import Queue
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.parse import urlparse
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    import http.client as httplib
+    import queue as Queue
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def compress(data, encoding):
+    """
+    Compress bytes with the 'gzip' or 'deflate' HTTP content coding.
+    """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    elif encoding == 'deflate':
+        return zlib.compress(data)
+    raise ValueError("encoding must be 'gzip' or 'deflate'.")
+
+
+class TransferStats(object):
+    """
+    Byte counts for the requests and responses of a transport, as sent over the network and before compression.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.request_bytes = 0
+        self.request_raw_bytes = 0
+        self.response_bytes = 0
+        self.response_raw_bytes = 0
+
+    def add(self, request_bytes=0, request_raw_bytes=0, response_bytes=0, response_raw_bytes=0):
+        with self.lock:
+            self.request_bytes += request_bytes
+            self.request_raw_bytes += request_raw_bytes
+            self.response_bytes += response_bytes
+            self.response_raw_bytes += response_raw_bytes
+
+    def saved(self):
+        """
+        Bytes compression kept off the network, requests and responses together.
+        """
+        with self.lock:
+            return self.request_raw_bytes - self.request_bytes + self.response_raw_bytes - self.response_bytes
+
+
+class Transport(object):
+    """
+    Base transport. Subclasses implement open(), returning a file-like response whose read() gives the body.
+    A body of None means a GET, anything else is POSTed.
+
+    HTTP transports ask for gzip or deflate responses unless accept_encoding is False, and decompress them as they
+    are read. compress_requests, 'gzip' or 'deflate', compresses request bodies too; only set it for servers known
+    to accept compressed bodies. Byte counts are kept in stats.
+    """
+    compress_requests = None
+    accept_encoding = True
+    stats = None
+
+    def __init__(self, compress_requests=None, accept_encoding=True):
+        self.compress_requests = compress_requests
+        self.accept_encoding = accept_encoding
+        self.stats = TransferStats()
+
+    def open(self, url, body=None, timeout=None):
+        raise NotImplementedError
+
+    def request(self, url, body=None, timeout=None):
+        return self.open(url, body, timeout).read()
+
+    def _prepare(self, body):
+        """
+        The body as bytes, compressed if asked for, and the headers to send with it.
+        """
+        headers = {}
+        if self.accept_encoding:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        if body is not None:
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+            raw_size = len(body)
+            if self.compress_requests:
+                body = compress(body, self.compress_requests)
+                headers['Content-Encoding'] = self.compress_requests
+            if self.stats is not None:
+                self.stats.add(request_bytes=len(body), request_raw_bytes=raw_size)
+        return body, headers
+
+
+class DecodedResponse(object):
+    """
+    File-like response that decompresses a gzip or deflate body as it is read, counting bytes into stats. An
+    encoding of None passes the body through, still counted.
+    """
+
+    def __init__(self, response, encoding=None, stats=None, chunk_size=16 * 1024):
+        self.response = response
+        self.stats = stats
+        self.chunk_size = chunk_size
+        self.buffer = b''
+        self.eof = False
+        self.decompressor = None
+        self.encoding = (encoding or '').strip().lower() or None
+        if self.encoding in ('gzip', 'x-gzip'):
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+        self.first_chunk = True
+
+    def _decompress(self, chunk):
+        if self.decompressor is None:
+            return chunk
+        try:
+            data = self.decompressor.decompress(chunk)
+        except zlib.error:
+            if not (self.first_chunk and self.encoding == 'deflate'):
+                raise IOError('Could not decompress the ' + self.encoding + ' response')
+            # Some servers send raw deflate without the zlib header
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self.decompressor.decompress(chunk)
+        self.first_chunk = False
+        return data
+
+    def read(self, size=-1):
+        while not self.eof and (size is None or size < 0 or len(self.buffer) < size):
+            chunk = self.response.read(self.chunk_size)
+            if not chunk:
+                self.eof = True
+                if self.decompressor is not None:
+                    data = self.decompressor.flush()
+                    if self.stats is not None:
+                        self.stats.add(response_raw_bytes=len(data))
+                    self.buffer += data
+                break
+            data = self._decompress(chunk)
+            if self.stats is not None:
+                self.stats.add(response_bytes=len(chunk), response_raw_bytes=len(data))
+            self.buffer += data
+        if size is None or size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class UrllibTransport(Transport):
+    """
+    The default transport, one urllib request per call.
+    """
+
+    def open(self, url, body=None, timeout=None):
+        body, headers = self._prepare(body)
+        request = Request(url, body, headers)
+        if timeout is None:
+            response = urlopen(request)
+        else:
+            response = urlopen(request, timeout=timeout)
+        return DecodedResponse(response, response.info().get('Content-Encoding'), self.stats)
+
+
+class PooledTransport(Transport):
+    """
+    Keeps persistent HTTP connections per host and shares them between threads. A thread takes an idle connection,
+    or opens a new one if none is idle, and hands it back once the response has been read to the end. At most
+    max_idle connections are kept per host.
+    """
+
+    def __init__(self, max_idle=10, compress_requests=None, accept_encoding=True):
+        Transport.__init__(self, compress_requests, accept_encoding)
+        self.max_idle = max_idle
+        # (scheme, host) -> queue of idle connections
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def _pool(self, key):
+        with self.lock:
+            if key not in self.pools:
+                self.pools[key] = Queue.LifoQueue(self.max_idle)
+            return self.pools[key]
+
+    def open(self, url, body=None, timeout=None):
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        selector = parsed.path + ('?' + parsed.query if parsed.query else '')
+        body, headers = self._prepare(body)
+        pool = self._pool(key)
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        for attempt in (0, 1):
+            try:
+                connection = pool.get_nowait()
+                reused = True
+            except Queue.Empty:
+                connection_class = httplib.HTTPSConnection if parsed.scheme == 'https' else httplib.HTTPConnection
+                connection = connection_class(parsed.netloc, timeout=timeout)
+                reused = False
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request('GET' if body is None else 'POST', selector, body, headers)
+                response = connection.getresponse()
+                break
+            except (IOError, httplib.HTTPException):
+                connection.close()
+                # The server may have closed an idle connection; retry once on a fresh one.
+                if not reused or attempt:
+                    raise
+        pooled = PooledResponse(pool, connection, response)
+        if response.status >= 400:
+            pooled.read()
+            raise IOError('HTTP error %d from "%s"' % (response.status, url))
+        return DecodedResponse(pooled, response.getheader('Content-Encoding'), self.stats)
+
+
+class PooledResponse(object):
+    """
+    File-like response that returns its connection to the pool once the body has been read to the end.
+    """
+
+    def __init__(self, pool, connection, response):
+        self.pool = pool
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+
+    def read(self, size=-1):
+        data = self.response.read() if size is None or size < 0 else self.response.read(size)
+        if self.connection is not None and (not data or size is None or size < 0):
+            self.release()
+        return data
+
+    def release(self):
+        connection, self.connection = self.connection, None
+        if self.response.will_close:
+            connection.close()
+            return
+        try:
+            self.pool.put_nowait(connection)
+        except Queue.Full:
+            connection.close()
+
+
+class ReplayTransport(Transport):
+    """
+    Serves responses recorded in a JSON file, keyed by request path and body so recordings work against any
+    apiBase. If a transport is given, requests missing from the file are passed to it and recorded; call save() to
+    write them out. Without one, a missing request raises IOError as an unreachable server would.
+    """
+
+    def __init__(self, filename, transport=None):
+        # Replayed responses never touch the network, so stats stay at zero; a wrapped transport keeps its own.
+        Transport.__init__(self)
+        self.filename = filename
+        self.transport = transport
+        self.responses = {}
+        self.lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self.responses = json.load(f)
+
+    def key(self, url, body=None):
+        path = urlparse(url).path
+        if body is None:
+            return path
+        return path + '\n' + _text(body)
+
+    def open(self, url, body=None, timeout=None):
+        key = self.key(url, body)
+        response_string = self.responses.get(key)
+        if response_string is None:
+            if self.transport is None:
+                raise IOError('No recorded response for "' + key.split('\n')[0] + '"')
+            response_string = _text(self.transport.request(url, body, timeout))
+            with self.lock:
+                self.responses[key] = response_string
+        return BytesIO(response_string.encode('utf-8'))
+
+    def save(self):
+        with self.lock:
+            with open(self.filename, 'w') as f:
+                json.dump(self.responses, f, indent=1, sort_keys=True)
+
+
+class StubServer(object):
+    """
+    A local HTTP server answering from a transport, usually a ReplayTransport. Point DSTK's apiBase at
+    stub.api_base to exercise the full urllib path without a DSTK install. Unknown requests get a 404. Compressed
+    request bodies are accepted, and responses are gzipped for clients asking for it if compress_responses is set.
+    """
+
+    def __init__(self, transport, host='127.0.0.1', port=0, compress_responses=True):
+        self.transport = transport
+        self.compress_responses = compress_responses
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections open, as DSTK behind a web server would.
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(handler):
+                self.respond(handler, None)
+
+            def do_POST(handler):
+                length = int(handler.headers.get('content-length') or 0)
+                body = handler.rfile.read(length)
+                if handler.headers.get('content-encoding'):
+                    body = DecodedResponse(BytesIO(body), handler.headers.get('content-encoding')).read()
+                self.respond(handler, body)
+
+            def log_message(handler, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.api_base = 'http://%s:%d' % self.server.server_address
+        self.thread = None
+
+    def respond(self, handler, body):
+        try:
+            response_string = self.transport.request(self.api_base + handler.path, body)
+            if not isinstance(response_string, bytes):
+                response_string = response_string.encode('utf-8')
+        except IOError:
+            handler.send_error(404)
+            return
+        encoding = None
+        accepted = [value.strip() for value in (handler.headers.get('accept-encoding') or '').split(',')]
+        if self.compress_responses and 'gzip' in accepted:
+            encoding = 'gzip'
+            response_string = compress(response_string, encoding)
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        if encoding:
+            handler.send_header('Content-Encoding', encoding)
+        handler.send_header('Content-Length', str(len(response_string)))
+        handler.end_headers()
+        handler.wfile.write(response_string)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
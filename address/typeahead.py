@@ -0,0 +1,68 @@
+# "Starts with" suggestions over the city and street lexicons, e.g. for an address entry form.
+
+from bisect import bisect_left
+
+
+class PrefixIndex(object):
+    """
+    A sorted tuple of unique lower case words. A completion is one binary search for the prefix and then a walk
+    over the next k words, so lookups cost O(log n + k) however large the list is.
+    """
+
+    def __init__(self, words):
+        self.words = tuple(sorted(set(word.strip().lower() for word in words if word and word.strip())))
+
+    def __len__(self):
+        return len(self.words)
+
+    def complete(self, prefix, k=10):
+        """
+        Up to k words starting with prefix, in alphabetical order, so an exact match comes first.
+        """
+        prefix = " ".join(prefix.lower().split())
+        words = self.words
+        completions = []
+        position = bisect_left(words, prefix)
+        while position < len(words) and len(completions) < k and words[position].startswith(prefix):
+            completions.append(words[position])
+            position += 1
+        return completions
+
+
+class Typeahead(object):
+    """
+    Prefix indexes over the cities and streets of an AddressParser's lexicon, including custom lists passed to the
+    parser. City completions can be limited to a state when the lexicon has per state cities; those indexes are
+    built the first time each state is asked for. The indexes are a snapshot: build a new Typeahead after
+    AddressParser.swap_lexicon().
+    """
+
+    def __init__(self, parser):
+        self.lexicon = parser.lexicon
+        self.cities = PrefixIndex(list(self.lexicon.cities) +
+                                  [city for cities in list(self.lexicon.state_cities.values()) if cities
+                                   for city in cities])
+        self.streets = PrefixIndex(self.lexicon.streets)
+        # State code -> PrefixIndex, or None for states without their own list
+        self.state_indexes = {}
+
+    def complete_city(self, prefix, k=10, state=None):
+        """
+        Up to k cities starting with prefix. With a state that has its own city list, only its cities are
+        suggested; otherwise every known city is.
+        """
+        if state is not None:
+            state = state.upper()
+            if state not in self.state_indexes:
+                cities = self.lexicon.cities_for_state(state)
+                self.state_indexes[state] = PrefixIndex(cities) if cities is not None else None
+            if self.state_indexes[state] is not None:
+                return self.state_indexes[state].complete(prefix, k)
+        return self.cities.complete(prefix, k)
+
+    def complete_street(self, prefix, k=10):
+        """
+        Up to k streets starting with prefix. The default streets list is empty, so this needs the parser to have
+        been given streets.
+        """
+        return self.streets.complete(prefix, k)
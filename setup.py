@@ -11,11 +11,12 @@ setup(
     #data_files=[('', ['README.rst','pyaddress/cities.csv', 'pyaddress/suffixes.csv', 'pyaddress/streets.csv', 'pyaddress/tests.py', 'pyaddress/test_list.py'])],
     packages=['address'],
     package_dir={'address': 'address'},
-    package_data={'address': ['cities.csv', 'streets.csv', 'suffixes.csv']},
+    package_data={'address': ['cities.csv', 'streets.csv', 'suffixes.csv', 'zip3.csv']},
     classifiers=[
         "License :: OSI Approved :: BSD License",
         "Natural Language :: English",
-        "Programming Language :: Python :: 2 :: Only",
+        "Programming Language :: Python :: 2",
+        "Programming Language :: Python :: 3",
         "Topic :: Software Development :: Libraries",
         "Topic :: Text Processing",
     ],